@@ -1,9 +1,12 @@
 #!/usr/bin/python3
-"""Usage: create_tables.py [-c <file>]
+"""Usage: create_tables.py [-c <file>] [--drop-indexes]
 
-Create tables for the GTFS database
+Create tables and indexes for the GTFS database
 Options:
   -c <file>, --config <file>  Use the specified configuration file.
+  --drop-indexes              Create the tables, but drop their indexes (except
+                              primary keys) before a bulk load. Run again without
+                              this option after loading to create them.
 """
 # Copyright (C) 2018 Elad Alfassa <elad@fedoraproject.org>
 #
@@ -35,7 +38,27 @@ async def main():
     config.read(configfile)
     engine = await gino.create_engine(config['gino']['dsn'])
     db.bind = engine
+    # get_nearby_stops() uses earthdistance for radius queries
+    await db.status("CREATE EXTENSION IF NOT EXISTS cube")
+    await db.status("CREATE EXTENSION IF NOT EXISTS earthdistance")
     await db.gino.create_all()
+    if arguments['--drop-indexes']:
+        # Loading into tables without indexes is a lot faster than updating
+        # every index for every row
+        await db.status("DROP INDEX IF EXISTS ix_stops_earth_location")
+        for table in db.sorted_tables:
+            for index in table.indexes:
+                await db.status(f"DROP INDEX IF EXISTS {index.name}")
+        return
+    # create_all() skips existing tables along with their indexes,
+    # so create indexes that were added to the model later
+    for table in db.sorted_tables:
+        for index in table.indexes:
+            columns = ', '.join(column.name for column in index.columns)
+            await db.status(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index.name} "
+                            f"ON {table.name} ({columns})")
+    await db.status("CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_stops_earth_location "
+                    "ON stops USING gist (ll_to_earth(stop_lat, stop_lon))")
 
 if __name__ == "__main__":
     loop = asyncio.get_event_loop()
@@ -24,10 +24,21 @@
 
 # This file intentionally only supports a small subset of GTFS needed for curlbus
 import re
+import sys
 from gino import Gino
-from sqlalchemy import select
+from sqlalchemy import select, text
+# Non-greedy groups surrounded by optional whitespace, so values come out
+# already stripped and each group stops at the first following label.
+# The floor ends at the end of its line, anything after it (like a stray
+# line break from the CSV) is ignored
 STOP_DESC_REGEX = re.compile(
-    "(?:רחוב:)(?P<street>.*)(?:עיר:)(?P<city>.*)(?:רציף:)(?P<platform>.*)(?:קומה:)(?P<floor>.*)")
+    r"\s*רחוב:\s*(?P<street>.*?)\s*עיר:\s*(?P<city>.*?)\s*רציף:\s*(?P<platform>.*?)\s*קומה:\s*(?P<floor>.*?)\s*$",
+    re.MULTILINE)
+
+LAST_STOP_CODE_QUERY = text("""SELECT stop_code FROM stoptimes AS st
+                               JOIN stops AS s ON s.stop_id=st.stop_id
+                               WHERE trip_id=:trip_id
+                               ORDER BY st.stop_sequence DESC LIMIT 1;""")
 
 db = Gino()
 
@@ -64,10 +75,9 @@ class Stop(db.Model):
     parent_station = db.Column(db.Unicode)
     zone_id = db.Column(db.Unicode)
 
-    def __init__(self, *args, **kwargs):
-        self._address = None
-        self.translated_name = None
-        super().__init__(*args, **kwargs)
+    # Not a database column. A class level default, so instances only get
+    # their own attribute once an address is actually parsed
+    _address = None
 
     @property
     def address(self):
@@ -85,10 +95,9 @@ class Stop(db.Model):
         if not self.stop_desc:
             return {}
 
-        match = STOP_DESC_REGEX.match(self.stop_desc.strip())
+        match = STOP_DESC_REGEX.match(self.stop_desc)
         if match is not None:
-            self._address = {k: v.strip()
-                             for k, v in match.groupdict().items()}
+            self._address = match.groupdict()
         else:
             self._address = {}
         return self._address
@@ -114,6 +123,10 @@ class Route(db.Model):
     route_type = db.Column(db.Integer)
     route_color = db.Column(db.Unicode)
 
+    # Routes are looked up by operator and route number
+    _agency_short_name_idx = db.Index('ix_routes_agency_id_route_short_name',
+                                      'agency_id', 'route_short_name')
+
     def __repr__(self):
         return f'<Route {self.route_id}>'
 
@@ -131,20 +144,21 @@ class Trip(db.Model):
     shape_id = db.Column(db.Unicode)
     wheelchair_accessible = db.Column(db.Unicode)
 
+    # get_route_route looks for a trip by route and direction
+    _route_direction_idx = db.Index('ix_trips_route_id_direction_id',
+                                    'route_id', 'direction_id')
+
     def __repr__(self):
         return f'<Trip {self.trip_id}>'
 
     async def get_stop_times(self, connection):
-        """ Get all StopTime objects associated with this trip """
-        stoptimes = await connection.all(StopTime.query.where(StopTime.trip_id == self.trip_id))
-        return sorted(stoptimes, key=lambda s: s.stop_sequence)
+        """ Get all StopTime objects associated with this trip, ordered by stop sequence """
+        return await connection.all(StopTime.query.where(StopTime.trip_id == self.trip_id)
+                                    .order_by(StopTime.stop_sequence))
 
     async def get_last_stop_code(self, connection):
         """ Return the destination stop_code for this trip """
-        return await connection.scalar(f"""SELECT stop_code FROM stoptimes AS st
-                                           JOIN stops AS s ON s.stop_id=st.stop_id
-                                           WHERE trip_id='{self.trip_id}'
-                                           ORDER BY st.stop_sequence DESC LIMIT 1;""")
+        return await connection.scalar(LAST_STOP_CODE_QUERY, trip_id=self.trip_id)
 
 
 class StopTime(db.Model):
@@ -160,6 +174,10 @@ class StopTime(db.Model):
     drop_off_type = db.Column(db.Boolean)
     shape_dist_traveled = db.Column(db.Unicode)
 
+    # Stoptimes of a trip are fetched in stop sequence order
+    _trip_sequence_idx = db.Index('ix_stoptimes_trip_id_stop_sequence',
+                                  'trip_id', 'stop_sequence')
+
     def __repr__(self):
         template = '<StopTime trip={0},time={1},stop_id={2},sequence={3}>'
         return template.format(self.trip_id,
@@ -197,13 +215,35 @@ class Translation(db.Model):
             if lang is not None:
                 return await connection.first(query.where(Translation.lang == lang))
             else:
-                ret = {t.lang: t.translation for t in await connection.all(query)}
+                # Interned, so the many cached dicts share one key object per language
+                ret = {sys.intern(t.lang): t.translation for t in await connection.all(query)}
                 if len(ret) == 0:
                     return {"HE": source2}
                 return ret
         except AttributeError:
             return {"HE": source2}
 
+    @staticmethod
+    async def get_many(connection, sources) -> dict:
+        """ Get translations for all strings in `sources` using a single query.
+        Returns a dictionary mapping each source string to what `get` would return for it """
+        sources = set(sources)
+        if not sources:
+            return {}
+        # See the comment in get() about the .replace
+        replaced = {source: source.replace("''", '"') for source in sources}
+        query = Translation.query.where(
+            Translation.trans_id.in_(sources | set(replaced.values())))
+        found = {}
+        for t in await connection.all(query):
+            # Interned language codes, see get()
+            found.setdefault(t.trans_id, {})[sys.intern(t.lang)] = t.translation
+        ret = {}
+        for source, source2 in replaced.items():
+            translations = {**found.get(source, {}), **found.get(source2, {})}
+            ret[source] = translations if translations else {"HE": source2}
+        return ret
+
     def __repr__(self):
         return '<Translation of %s (to %s): %s>' % (self.trans_id, self.lang,
                                                     self.translation)
@@ -224,6 +264,21 @@ class City(db.Model):
         return f'<City translation {self.name}={self.english_name}>'
 
 
+class RouteTranslation(db.Model):
+    """ English long names of routes, precomputed by load_route_translations.py after
+    loading the GTFS feed. This is not a GTFS type either """
+    __tablename__ = 'route_translations'
+
+    route_id = db.Column(db.Unicode, primary_key=True)
+    """ The route_id of the translated route """
+
+    long_name_en = db.Column(db.Unicode)
+    """ The translated route_long_name """
+
+    def __repr__(self):
+        return f'<RouteTranslation {self.route_id}={self.long_name_en}>'
+
+
 class TAShabbatStop(db.Model):
     """ mapping between stop_ids in the Tel Aviv Shabbat buses GTFS feed to the MoT GTFS stop_ids """
     __tablename__ = 'telaviv_shabbat_stops'
@@ -236,6 +291,8 @@ class TAShabbatStop(db.Model):
 
     @staticmethod
     async def get_mapped_stop_codes(connection, stop_ids):
+        if not stop_ids:
+            return {}
         query = select([TAShabbatStop.ta_stop_id, Stop.stop_code]).where(
             TAShabbatStop.ta_stop_id.in_(stop_ids)).where(Stop.stop_id == TAShabbatStop.stop_id)
         result = await connection.all(query)
@@ -247,4 +304,4 @@ class TAShabbatStop(db.Model):
         return ret
 
 
-tables = (Agency, Route, Trip, Stop, StopTime, Translation, City)
+tables = (Agency, Route, Trip, Stop, StopTime, Translation, City, RouteTranslation)
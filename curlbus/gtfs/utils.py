@@ -15,28 +15,237 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
-from typing import List, Dict
-import geopy.distance
-from aiocache import cached
-from sqlalchemy import func, select
-from .model import Trip, Route, Stop, StopTime, Agency, Translation, City
+from typing import List, Dict, Optional
+import asyncio
+import json
+import sys
+from aiocache import cached, SimpleMemoryCache
+from aiocache.base import BaseCache
+from aiocache.serializers import NullSerializer
+from sqlalchemy import bindparam, func, select, text
+from .model import Trip, Route, Stop, StopTime, Translation, City, RouteTranslation
 from .town_synonyms import towns
 from ..operators import operator_names, operators
 
 MINUTES = 60*60
 
+STOP_COLUMNS = ('stop_id', 'stop_code', 'stop_name', 'stop_desc', 'stop_lat', 'stop_lon')
+""" Stop columns needed to build a Stop object from a raw query row """
+
+STOPS_QUERY = select([getattr(Stop, column) for column in STOP_COLUMNS]).execution_options(loader=Stop)
+""" Loads Stop objects with only the columns in STOP_COLUMNS """
+
+# The agency, the trip and its destination stop. The destination is the
+# trip's last stop, or the stop with the realtime destination code when the
+# trip is missing from the GTFS feed. Trip/stop columns are NULL when missing.
+ARRIVAL_GTFS_INFO_QUERY = text("""SELECT a.agency_name, a.agency_url,
+                                         t.trip_id, t.trip_headsign,
+                                         s.stop_id, s.stop_code, s.stop_name,
+                                         s.stop_desc, s.stop_lat, s.stop_lon
+                                  FROM agency AS a
+                                  LEFT JOIN trips AS t ON t.trip_id=:trip_id
+                                  LEFT JOIN LATERAL (SELECT st.stop_id FROM stoptimes AS st
+                                                     WHERE st.trip_id=t.trip_id
+                                                     ORDER BY st.stop_sequence DESC
+                                                     LIMIT 1) AS last ON true
+                                  LEFT JOIN stops AS s
+                                    ON s.stop_id=COALESCE(last.stop_id,
+                                                          (SELECT stop_id FROM stops
+                                                           WHERE stop_code=:destination_code
+                                                           LIMIT 1))
+                                  WHERE a.agency_id=:agency_id""")
+
+# Built once with bound parameters instead of constructing a new query per call.
+# Sorted by id to make sure the order is consistent when there are
+# multiple routes with the same name and operator
+ROUTES_QUERY = (select([Route.route_id, Route.agency_id, Route.route_short_name, Route.route_long_name])
+                .execution_options(loader=Route)
+                .where(Route.agency_id == bindparam('agency_id'))
+                .where(Route.route_short_name == bindparam('route_name'))
+                .order_by(Route.route_id))
+
+ROUTE_TRANSLATION_QUERY = (select([RouteTranslation.long_name_en])
+                           .where(RouteTranslation.route_id == bindparam('route_id')))
+
+# Stations of an agency, with a row per station name translation (see
+# Translation.get for the replace) and the English name from the cities table
+RAIL_STATIONS_QUERY = text("""SELECT s.stop_code, s.stop_name, tr.lang, tr.translation, c.english_name
+                              FROM (SELECT distinct s.stop_code, s.stop_name
+                                    FROM stops AS s
+                                    WHERE EXISTS (SELECT 1 FROM stoptimes AS st
+                                                  JOIN trips as t ON t.trip_id=st.trip_id
+                                                  JOIN routes as r ON r.route_id=t.route_id
+                                                  WHERE st.stop_id=s.stop_id
+                                                  AND r.agency_id=:agency_id)) AS s
+                              LEFT JOIN translations AS tr
+                                ON tr.trans_id IN (s.stop_name, replace(s.stop_name, '''''', '"'))
+                              LEFT JOIN cities AS c ON c.name=s.stop_name""")
+
+# The whole get_nearby_stops response as a JSON array. Translated names are
+# built the same way as Translation.get does, falling back to the Hebrew name.
+# Uses the earthdistance extension: earth_box() is a (slightly larger) bounding
+# cube that can use the GiST index on stop locations, and earth_distance()
+# narrows the result down into a circular radius.
+NEARBY_STOPS_QUERY = text("""SELECT COALESCE(json_agg(json_build_object(
+                                 'code', s.stop_code,
+                                 'name', COALESCE(names.name,
+                                                  jsonb_build_object('HE', replace(s.stop_name, '''''', '"'))),
+                                 'distance', round(s.distance::numeric, 2),
+                                 'location', json_build_object('lat', s.stop_lat, 'lon', s.stop_lon))), '[]')
+                             FROM (SELECT stop_code, stop_name, stop_lat, stop_lon,
+                                          earth_distance(ll_to_earth(:lat, :lon),
+                                                         ll_to_earth(stop_lat, stop_lon)) AS distance
+                                   FROM stops
+                                   WHERE earth_box(ll_to_earth(:lat, :lon), :radius)
+                                         @> ll_to_earth(stop_lat, stop_lon)) AS s
+                             LEFT JOIN LATERAL (SELECT jsonb_object_agg(tr.lang, tr.translation) AS name
+                                                FROM translations AS tr
+                                                WHERE tr.trans_id IN (s.stop_name,
+                                                                      replace(s.stop_name, '''''', '"'))
+                                               ) AS names ON true
+                             WHERE s.distance <= :radius""")
+
+
+shared_cache: Optional[BaseCache] = None
+""" Optional cache shared between server processes (eg. Redis), see `set_shared_cache` """
+
+
+def set_shared_cache(cache: Optional[BaseCache]):
+    """ Use `cache` as a second tier for functions decorated with `cached_no_db(shared=True)`.
+    The cache must serialize values itself, and only JSON-friendly values are stored in it """
+    global shared_cache
+    shared_cache = cache
+
 
 class cached_no_db(cached):
+    """ In-memory cache decorator that ignores the first ("db") argument.
+
+    Values are stored without serialization, so a cache hit returns the very
+    same object - callers must not modify returned values in place.
+
+    With shared=True, the shared cache (if configured) is checked on a miss
+    and written to along with the in-memory one """
+    def __init__(self, *args, cache=SimpleMemoryCache, serializer=None, shared=False, **kwargs):
+        super().__init__(*args, cache=cache,
+                         serializer=serializer or NullSerializer(), **kwargs)
+        self.shared = shared
+        self._pending: Dict[str, asyncio.Future] = {}
+
     def get_cache_key(self, f, args, kwargs):
         # remove "db" from args for the cache key
         return self._key_from_args(f, args[1:], kwargs)
 
+    async def get_from_cache(self, key):
+        value = await super().get_from_cache(key)
+        if value is None and self.shared and shared_cache is not None:
+            try:
+                value = await shared_cache.get(key)
+            except Exception as e:
+                # The shared cache is only an optimization, fall back to the database
+                print('Shared cache error', e)
+                return None
+            if value is not None:
+                await super().set_in_cache(key, value)
+        return value
+
+    async def set_in_cache(self, key, value):
+        await super().set_in_cache(key, value)
+        if self.shared and shared_cache is not None:
+            try:
+                await shared_cache.set(key, value, ttl=self.ttl)
+            except Exception as e:
+                print('Shared cache error', e)
+
+    async def decorator(self, f, *args, **kwargs):
+        # Coalesce concurrent calls with the same key, so when a popular entry
+        # expires only the first caller queries the database and the rest wait
+        # for its result.
+        key = self.get_cache_key(f, args, kwargs)
+        pending = self._pending.get(key)
+        if pending is not None:
+            try:
+                return await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if not pending.cancelled():
+                    # This caller was cancelled
+                    raise
+                # The caller doing the lookup was cancelled, take over from it
+                return await self.decorator(f, *args, **kwargs)
+
+        pending = self._pending[key] = asyncio.get_event_loop().create_future()
+        try:
+            result = await super().decorator(f, *args, **kwargs)
+        except Exception as e:
+            pending.set_exception(e)
+            # The exception is raised to this caller anyway, so mark it as
+            # retrieved to avoid a warning when nobody else was waiting
+            pending.exception()
+            raise
+        else:
+            pending.set_result(result)
+            return result
+        finally:
+            del self._pending[key]
+            if not pending.done():
+                # this caller was cancelled, don't leave the others waiting
+                # forever - one of them will do the lookup instead
+                pending.cancel()
+
+
+class TranslationLoader(object):
+    """ Batches translation lookups of concurrent coroutines: all sources requested
+    during the same event loop iteration are fetched with one `Translation.get_many` query """
+    def __init__(self, db):
+        self.db = db
+        self._pending: Dict[str, asyncio.Future] = {}
+
+    async def load(self, source: str) -> dict:
+        """ Same as `Translation.get(db, source)` """
+        future = self._pending.get(source)
+        if future is None:
+            loop = asyncio.get_event_loop()
+            if not self._pending:
+                # First source of this batch, dispatch once everyone
+                # else that's ready to run had a chance to add theirs
+                loop.call_soon(self._dispatch)
+            future = self._pending[source] = loop.create_future()
+        # Don't let a cancelled caller cancel the lookup for everyone else
+        return await asyncio.shield(future)
+
+    def _dispatch(self):
+        pending, self._pending = self._pending, {}
+        asyncio.ensure_future(self._load_many(pending))
+
+    async def _load_many(self, pending: Dict[str, asyncio.Future]):
+        try:
+            translations = await Translation.get_many(self.db, pending.keys())
+        except Exception as e:
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for source, future in pending.items():
+                if not future.done():
+                    future.set_result(translations[source])
 
-@cached_no_db(ttl=30*MINUTES)
+
+_translation_loaders: Dict[object, TranslationLoader] = {}
+
+
+@cached_no_db(ttl=30*MINUTES, shared=True)
+async def get_translation(db, source):
+    """ Cached version of `Translation.get`. Translations only change when the GTFS feed is reloaded """
+    loader = _translation_loaders.get(db)
+    if loader is None:
+        loader = _translation_loaders[db] = TranslationLoader(db)
+    return await loader.load(source)
+
+
+@cached_no_db(ttl=30*MINUTES, shared=True)
 async def translate_city_name(db, city, lang='EN'):
     ret = None
     # Prefer the official GTFS translation database
-    city_translation = await Translation.get(db, city)
+    city_translation = await get_translation(db, city)
     if  lang in city_translation:
         ret = city_translation[lang]
     elif lang == 'EN':
@@ -47,64 +256,81 @@ async def translate_city_name(db, city, lang='EN'):
     return ret
 
 
-@cached_no_db(ttl=30*MINUTES)
-async def get_translated_address(db, stop):
-    """ Translates the 'city' value in a stop's address, if possible """
-    address = stop.address
-    if not stop.address:
-        return None
+async def translate_city_names(db, cities) -> Dict[str, Dict[str, str]]:
+    """ Translate many city names at once.
+    Returns a dictionary mapping each city name to its translations, key'd on language """
+    ret = await Translation.get_many(db, cities)
+    # Fall back to the government city database for English
+    missing = [city for city, translations in ret.items() if 'EN' not in translations]
+    if missing:
+        for city in await db.all(City.query.where(City.name.in_(missing))):
+            ret[city.name]['EN'] = city.english_name
+    return ret
+
+
+def _translate_address(address, city_translations):
+    """ Returns a copy of `address` with the city name translations
+    (a dictionary key'd on language) added """
+    # Copy, to avoid modifying the Stop's own address
+    address = dict(address)
     address['city_multilingual'] = {
         'HE': address['city']
     }
-    translation = await translate_city_name(db, stop.address['city'])
+    translation = city_translations.get('EN')
     if translation is not None:
         address['city'] = translation
         address['city_multilingual']['EN'] = translation
-    ar_translation = await translate_city_name(db, stop.address['city'], 'AR')
+    ar_translation = city_translations.get('AR')
     if ar_translation:
-        address['city_multilingual']['AR'] = translation
+        address['city_multilingual']['AR'] = ar_translation
     return address
 
 
-async def get_arrival_gtfs_info(arrival, db):
-        trip_query = db.first(Trip.query.where(Trip.trip_id == str(arrival.trip_id)))
-        agency_query = db.first(Agency.query.where(Agency.agency_id == arrival.operator_id))
+@cached_no_db(ttl=30*MINUTES)
+async def get_translated_address(db, stop, langs=('EN',)):
+    """ Translates the 'city' value in a stop's address to the languages in `langs`, if possible """
+    address = stop.address
+    if not stop.address:
+        return None
+    city = address['city']
+    translations = await asyncio.gather(*(translate_city_name(db, city, lang) for lang in langs))
+    return _translate_address(address, dict(zip(langs, translations)))
+
 
-        trip = await trip_query
-        agency = await agency_query
+async def get_arrival_gtfs_info(arrival, db):
+        # agency, trip and the trip's destination stop in a single round-trip
+        row = await db.first(ARRIVAL_GTFS_INFO_QUERY,
+                             trip_id=str(arrival.trip_id),
+                             agency_id=str(arrival.operator_id),
+                             destination_code=str(arrival.destination_id))
 
         destination = None
         destination_name = None
         destination_address = None
-
         headsign = None
-        agency = {"name": {"HE": agency.agency_name,
-                           "EN": operator_names[int(arrival.operator_id)]},
-                  "url": agency.agency_url}
-
-        if trip:
-            # Prefer destination from trip
-            last_stop = await trip.get_last_stop_code(db)
-            destination = await db.first(Stop.query.where(Stop.stop_code == last_stop))
-            destination_name = await Translation.get(db, destination.stop_name)
-            if trip.trip_headsign is not None:
-                headsign = await Translation.get(db, trip.trip_headsign)
-        else:
-            # if we don't have a trip (for example if the GTFS feed is broken)
-            # try using destination_id from the realtime data
-            destination = await db.first(Stop.query.where(Stop.stop_code == str(arrival.destination_id)))
-            if destination is not None:
-                destination_name = await Translation.get(db, destination.stop_name)
-            else:
-                # Sometimes the GTFS feed is so broken that it doesn't have
-                # some stops that the realtime data does have.
-                destination_name = None
-            headsign = None
 
-        if destination:
-            destination_address = await get_translated_address(db, destination)
-        else:
-            destination_address = None
+        agency = {"name": {"HE": row['agency_name'],
+                           "EN": operator_names[int(arrival.operator_id)]},
+                  "url": row['agency_url']}
+
+        # Sometimes the GTFS feed is so broken that it doesn't have the trip,
+        # and doesn't even have the destination stop the realtime data has.
+        if row['stop_id'] is not None:
+            destination = Stop(**{column: row[column] for column in STOP_COLUMNS})
+        trip_headsign = row['trip_headsign']
+
+        # The translations are independent of each other, look them up concurrently
+        if destination is not None and trip_headsign is not None:
+            destination_name, destination_address, headsign = await asyncio.gather(
+                get_translation(db, destination.stop_name),
+                get_translated_address(db, destination, ('EN', 'AR')),
+                get_translation(db, trip_headsign))
+        elif destination is not None:
+            destination_name, destination_address = await asyncio.gather(
+                get_translation(db, destination.stop_name),
+                get_translated_address(db, destination, ('EN', 'AR')))
+        elif trip_headsign is not None:
+            headsign = await get_translation(db, trip_headsign)
 
         if destination:
             destination = {"code": destination.stop_code,
@@ -119,16 +345,14 @@ async def get_arrival_gtfs_info(arrival, db):
                 "headsign": headsign}
 
 
-@cached_no_db(ttl=30*MINUTES)
+@cached_no_db(ttl=30*MINUTES, shared=True)
 async def get_stop_info(db_session, stop_code):
-    query = Stop.query.where(Stop.stop_code == stop_code).limit(1)
-    query.bind = db_session
-    stop = await query.gino.first()
+    stop = await db_session.first(STOPS_QUERY.where(Stop.stop_code == stop_code).limit(1))
     if stop is None:
         return None
 
-    return {"name": await Translation.get(db_session, stop.stop_name),
-            "address": await get_translated_address(db_session, stop),
+    return {"name": await get_translation(db_session, stop.stop_name),
+            "address": await get_translated_address(db_session, stop, ('EN', 'AR')),
             "location": {"lat": stop.stop_lat,
                          "lon": stop.stop_lon}}
 
@@ -136,11 +360,7 @@ async def get_stop_info(db_session, stop_code):
 @cached_no_db(ttl=30*MINUTES)
 async def get_routes(db, operator_id, route_name):
     """ Get info for route by operator and name """
-    routes = await db.all(Route.query.where(Route.agency_id == str(operator_id)).where(
-                                            Route.route_short_name == route_name))
-    # sorted by id to make sure the order is consistent when there are
-    # multiple routes with the same name and operator
-    routes = sorted(routes, key=lambda r: r.route_id)
+    routes = await db.all(ROUTES_QUERY, agency_id=str(operator_id), route_name=route_name)
     if operator_id != operators['tlv']:
         return [(route, None) for route in routes]
 
@@ -159,92 +379,141 @@ async def get_routes(db, operator_id, route_name):
     return ret
 
 
-@cached_no_db(ttl=30*MINUTES)
-async def get_routes_for_trips(db, trip_ids: List[str] = []) -> Dict[str, Dict[str, str]]:
-    """ For the GTFS-RT adapter - get route info for a collection of trips """
-    trips = await db.all(select([Trip.trip_id, Trip.direction_id, Route])
-                          .where(Trip.route_id == Route.route_id)
-                          .where(Trip.trip_id.in_(trip_ids)))
+async def query_routes_for_trips(db, trip_ids: List[str]) -> Dict[str, Dict[str, str]]:
+    """ Uncached `get_routes_for_trips`, for callers that rarely ask for the same trips twice """
+    if not trip_ids:
+        return {}
+    trips_query = (select([Trip.trip_id, Trip.direction_id, Route.route_id, Route.route_short_name,
+                           Route.route_long_name, Route.agency_id])
+                   .where(Trip.route_id == Route.route_id)
+                   .where(Trip.trip_id.in_(trip_ids)))
+    # The last stop of every trip, using DISTINCT ON to keep only
+    # the first (highest sequence) row per trip
+    destinations_query = (select([StopTime.trip_id, Stop.stop_code])
+                          .distinct(StopTime.trip_id)
+                          .where(StopTime.trip_id.in_(trip_ids))
+                          .where(Stop.stop_id == StopTime.stop_id)
+                          .order_by(StopTime.trip_id, StopTime.stop_sequence.desc()))
+    trips, destinations = await asyncio.gather(db.all(trips_query),
+                                               db.all(destinations_query))
+    destination_codes = {destination.trip_id: destination.stop_code
+                         for destination in destinations}
+
     ret: Dict[str, Dict[str, str]] = {}
     for trip in trips:
-        destination = await db.first(select([StopTime, Stop])
-                                      .where(StopTime.trip_id == trip.trip_id)
-                                      .where(Stop.stop_id == StopTime.stop_id)
-                                      .order_by(StopTime.stop_sequence.desc())
-                                    )
-
         ret[trip.trip_id] = {
+            'trip_id': trip.trip_id,
             'direction_id': trip.direction_id,
             'route_id': trip.route_id,
             'route_short_name': trip.route_short_name,
             'route_long_name': trip.route_long_name,
             'agency_id': trip.agency_id,
-            'destination_code': destination.stop_code
+            'destination_code': destination_codes.get(trip.trip_id)
         }
     return ret
 
 
+@cached_no_db(ttl=30*MINUTES)
+async def get_routes_for_trips(db, trip_ids: List[str] = []) -> Dict[str, Dict[str, str]]:
+    """ For the GTFS-RT adapter - get route info for a collection of trips """
+    return await query_routes_for_trips(db, trip_ids)
+
+
 @cached_no_db(ttl=15*MINUTES)
 async def get_route_route(db, route_id, direction_id):
-    """ Get an ordered list of stop objects that represent the route of a specific bus line """
+    """ Get an ordered list of stops (dictionaries with the stop code, translated
+    address and translated name) that represent the route of a specific bus line """
     # 1. Find a trip for this route
     # 2. Find StopTimes for this trip, build a dict mapping code -> sequence location
     # 3. Query stops, return sorted by lambda stop: sequence[stop.stop_code]
-    query = Trip.query.where(Trip.route_id == route_id)
+    query = select([Trip.trip_id]).execution_options(loader=Trip).where(Trip.route_id == route_id)
 
     if direction_id is not None:
-        query = Trip.query.where(Trip.route_id == route_id).where(Trip.direction_id == direction_id)
-
-    trip = await db.first(query)
-    if trip is None:
-        return None
-    stoptimes = await trip.get_stop_times(db)
-
-    sequence = {stoptime.stop_id: stoptime.stop_sequence for stoptime in stoptimes}
-
-    stops = await db.all(Stop.query.where(Stop.stop_id.in_(sequence.keys())))
-    for stop in stops:
-        # Translate addresses
-        stop.address = await get_translated_address(db, stop)
-        stop.translated_name = await Translation.get(db, stop.stop_name)
-    return sorted(stops, key=lambda stop: sequence[stop.stop_id])
+        query = query.where(Trip.direction_id == direction_id)
+
+    # These queries depend on each other, so run them on one connection,
+    # and return it to the pool before looking up translations
+    async with db.acquire() as connection:
+        trip = await connection.first(query.limit(1))
+        if trip is None:
+            return None
+        stoptimes = await trip.get_stop_times(connection)
+
+        sequence = {stoptime.stop_id: stoptime.stop_sequence for stoptime in stoptimes}
+
+        stops = await connection.all(STOPS_QUERY.where(Stop.stop_id.in_(sequence.keys())))
+    # Translate names and addresses of all stops at once
+    cities = {stop.address['city'] for stop in stops if stop.address}
+    names, city_translations = await asyncio.gather(
+        Translation.get_many(db, (stop.stop_name for stop in stops)),
+        translate_city_names(db, cities))
+    ret = []
+    for stop in sorted(stops, key=lambda stop: sequence[stop.stop_id]):
+        address = stop.address
+        if address:
+            address = _translate_address(address, city_translations[address['city']])
+        ret.append({"stop_code": stop.stop_code,
+                    "address": address,
+                    "name": names[stop.stop_name]})
+    return ret
 
 
 @cached_no_db(ttl=30*MINUTES)
 async def translate_route_name(db, route):
     """ Attempt to find a translation for a route's long name """
+    translation = await db.scalar(ROUTE_TRANSLATION_QUERY, route_id=route.route_id)
+    if translation is not None:
+        return translation
+    # Not precomputed (yet), translate it now
+    return await translate_route_long_name(db, route.route_long_name)
+
+
+async def translate_route_long_name(db, route_long_name: str) -> str:
+    """ Translate a route's long name using the GTFS translations and some heuristics """
     # long route names are in the following format:
     # route_long_name = רדינג-תל אביב יפו<->ת. מרכזית ת''א ק. 4/הורדה-תל אביב יפו-10
     # so a bunch of splits should get us proper translation
-    if '<->' in route.route_long_name:
+    if '<->' in route_long_name:
         separator = '<->'
     else:
         separator = ' - '
-    splitted = route.route_long_name.split(separator)
+    splitted = route_long_name.split(separator)
+    if len(splitted) == 2:
+        parts = splitted
+    else:
+        parts = [route_long_name]
+
+    # Split every part into a stop name and a town up front, so all the
+    # translations can be fetched at once
+    split_parts = []
+    for part in parts:
+        if '-' in part:
+            pieces = part.split('-', 2)
+            split_parts.append((part, pieces[0].strip(), pieces[1].strip()))
+        else:
+            split_parts.append((part, None, part))
+
+    stop_names = [stop_name for _, stop_name, _ in split_parts if stop_name]
+    translations, town_translations = await asyncio.gather(
+        Translation.get_many(db, [*parts, *stop_names]),
+        translate_city_names(db, [town for _, _, town in split_parts]))
 
-    async def translate_part(part):
+    def translate_part(part, stop_name, town):
         # in some cases we don't want to split at all
-        full_part_translation = await Translation.get(db, part, lang='EN')
-        if full_part_translation is not None:
-            return full_part_translation
+        if 'EN' in translations[part]:
+            return translations[part]['EN']
 
         # But in other cases, we need to do some heuristics
-        stop_name = None
-        if '-' in part:
-            stop_name = part.split('-')[0].strip()
-            stop_name_translation = await Translation.get(db, stop_name, lang='EN')
-            if stop_name_translation is not None:
-                stop_name = stop_name_translation.translation
-        town = part.split('-')[1].strip() if '-' in part else part
-        town_translation = await translate_city_name(db, town)
-        if town_translation is not None:
-            town = town_translation
+        if stop_name and 'EN' in translations[stop_name]:
+            stop_name = translations[stop_name]['EN']
+        town = town_translations[town].get('EN', town)
 
         if stop_name and (town.replace("-", "") in stop_name or town in stop_name):
             # To avoid extra useless data such as "Kiryat Ono Terminal-Kiryat Ono"
             # or the horrifying "Modi'in Macabim Re'ut Central Station/Alighting-Modi'in-Makabim-Re'ut"
             return stop_name
-        if town in towns and towns[town].match(stop_name):
+        town_regex = towns.get(town)
+        if stop_name and town_regex is not None and town_regex.match(stop_name):
             return stop_name
         else:
             if stop_name:
@@ -252,16 +521,10 @@ async def translate_route_name(db, route):
             else:
                 return town
 
-    if len(splitted) == 2:
-        origin, destination = splitted
-        origin_translation = await translate_part(origin)
-        dest_translation = await translate_part(destination)
-        return f'{origin_translation}<->{dest_translation}'
-    else:
-        return await translate_part(route.route_long_name)
+    return '<->'.join(translate_part(*split_part) for split_part in split_parts)
 
 
-@cached_no_db(ttl=30*MINUTES)
+@cached_no_db(ttl=30*MINUTES, shared=True)
 async def count_routes(db, operator_id: int) -> int:
     """ Count how many routes an operator has """
     # This query uses route_desc, which contains the official route license number
@@ -273,64 +536,35 @@ async def count_routes(db, operator_id: int) -> int:
     return await db.scalar(query.where(Route.agency_id == str(operator_id)))
 
 
-@cached_no_db(ttl=30*MINUTES)
+@cached_no_db(ttl=30*MINUTES, shared=True)
 async def get_rail_stations(db):
     """ Get all Israel Railways stations in the system """
     rail_agency_id = operators['rail']
-    stops = await db.all(f"""SELECT distinct s.stop_code, s.stop_name
-                             FROM stops AS s
-                             JOIN stoptimes AS st ON st.stop_id=s.stop_id
-                             JOIN trips as t ON t.trip_id=st.trip_id
-                             JOIN routes as r ON r.route_id=t.route_id
-                             WHERE r.agency_id='{rail_agency_id}'""")
+    rows = await db.all(RAIL_STATIONS_QUERY, agency_id=str(rail_agency_id))
+    names: Dict[tuple, Dict[str, str]] = {}
+    city_names: Dict[tuple, str] = {}
+    for stop_code, stop_name, lang, translation, city_name in rows:
+        station = (stop_code, stop_name)
+        name = names.setdefault(station, {})
+        if lang is not None:
+            name[sys.intern(lang)] = translation
+        if city_name is not None:
+            city_names[station] = city_name
+
     ret = []
-    for stop_code, stop_name in stops:
-        name = await Translation.get(db, stop_name)
-        if 'EN' not in name:
-            city_name = await db.first(City.query.where(City.name == stop_name))
-            if city_name is not None:
-                name['EN'] = city_name.english_name
+    for station, name in names.items():
+        stop_code, stop_name = station
+        if not name:
+            name = {"HE": stop_name.replace("''", '"')}
+        if 'EN' not in name and station in city_names:
+            name['EN'] = city_names[station]
         ret.append({"code": stop_code,
                     "name": name})
     return ret
 
 
 @cached_no_db(ttl=60*MINUTES)
-async def get_nearby_stops(db, lat: float, lon: float, radius: int, return_ids_only: bool = False):
+async def get_nearby_stops(db, lat: float, lon: float, radius: int):
     """ Get stops in the specified radius (in meters) """
-
-    radius_in_km = radius/1000
-    latlon = (lat, lon)
-
-    # Build the (square) bounding box
-    distance = geopy.distance.distance()
-    north = distance.destination(latlon, 0, radius_in_km).latitude
-    east = distance.destination(latlon, 90, radius_in_km).longitude
-    south = distance.destination(latlon, 180, radius_in_km).latitude
-    west = distance.destination(latlon, -90, radius_in_km).longitude
-
-    # Get a list of stops
-
-    stops = await db.all(Stop.query.
-                         where(Stop.stop_lon < east).
-                         where(Stop.stop_lon > west).
-                         where(Stop.stop_lat < north).
-                         where(Stop.stop_lat > south))
-    # the gino way to do sql AND is ugly :(
-
-    ret = []
-    for stop in stops:
-        dist = geopy.distance.distance(latlon, (stop.stop_lat, stop.stop_lon)).meters
-        # Narrow down the returned list into a circular radius
-        if dist <= radius:
-            if return_ids_only:
-                ret.append(stop.stop_id)
-            else:
-                name = await Translation.get(db, stop.stop_name)
-                ret.append({"code": stop.stop_code,
-                            "name": name,
-                            "distance": round(dist, 2),
-                            "location": {"lat": stop.stop_lat,
-                                        "lon": stop.stop_lon}})
-
-    return ret
\ No newline at end of file
+    # Let the database build the whole response, translations included
+    return json.loads(await db.scalar(NEARBY_STOPS_QUERY, lat=lat, lon=lon, radius=radius))
@@ -18,7 +18,7 @@
 
 import asyncio
 from datetime import datetime
-from typing import List, Dict
+from typing import List, Dict, NamedTuple, Tuple
 
 import aiohttp
 from aiocache import SimpleMemoryCache
@@ -40,10 +40,12 @@ MINUTES = 60*60
 
 class GtfsRtVisit(SIRIStopVisit):
     """ A `SIRIStopVisit` compatible object for represnting stop visits from GTFS-RT """
-    def __init__(self, feed, stop_time_update, stop_code: str, trip_info: Dict[str, str], vehicle: dict):
+    __slots__ = ()
+
+    def __init__(self, timestamp: datetime, stop_time_update, stop_code: str, trip_info: Dict[str, str], vehicle: dict):
         self.producer = 'GTFS-RT'
 
-        self.timestamp = datetime.fromtimestamp(feed.header.timestamp, tz=ISRAEL_TZ)
+        self.timestamp = timestamp
         """  GTFS-RT feed timestamp """
 
         self.stop_code = stop_code
@@ -93,41 +95,52 @@ class GtfsRtVisit(SIRIStopVisit):
         return "GtfsRtVisit <line: {0}, eta: {1}>".format(self.line_id, self.eta)
 
 
+class ParsedFeed(NamedTuple):
+    """ The parts of a GTFS-RT feed curlbus uses, extracted in a single walk over the feed entities """
+    trip_updates: List[Tuple[str, str, list]]
+    """ (trip_id, vehicle_id, stop_time_updates) for every trip update in the feed """
+    vehicle_positions: Dict[str, Dict[str, float]]
+    """ Vehicle positions, key'd on vehicle ID """
+
+
+def parse_feed(feed: FeedMessage) -> ParsedFeed:
+    """ Walk the feed entities once, collecting trip updates and vehicle positions """
+    trip_updates = []
+    vehicle_positions: Dict[str, Dict[str, float]] = {}
+    for entity in feed.entity:
+        if entity.HasField('vehicle'):
+            vehicle_positions[entity.vehicle.vehicle.id] = {
+                "lat": entity.vehicle.position.latitude,
+                "lon": entity.vehicle.position.longitude
+            }
+        elif entity.HasField('trip_update'):
+            trip_update = entity.trip_update
+            trip_updates.append((f'{TELAVIV_GTFS_ID_PREFIX}{trip_update.trip.trip_id}',
+                                 trip_update.vehicle.id,
+                                 list(trip_update.stop_time_update)))
+    return ParsedFeed(trip_updates, vehicle_positions)
+
+
 class GtfsRtResponse(SIRIResponse):
     """ A `SIRIResponse` compatible object for represnting stop visits from GTFS-RT """
-    def __init__(self, feed: FeedMessage, requested_stop_codes: List[str], trips_data: Dict[str, Dict[str, str]], stops_mapping: Dict[str, str], timestamp):
+    def __init__(self, parsed_feed: ParsedFeed, requested_stop_codes: List[str], trips_data: Dict[str, Dict[str, str]], stops_mapping: Dict[str, str], timestamp):
         self.errors = []
         self.visits: Dict[str, List[SIRIStopVisit]] = {code: [] for code in requested_stop_codes}
         self.timestamp = timestamp
-        vehicle_positions: Dict[str, Dict[str, str]] = {}
-
-        for entity in feed.entity:
-            if entity.HasField('vehicle'):
-                vehicle_positions[entity.vehicle.vehicle.id] = {
-                    "lat": entity.vehicle.position.latitude,
-                    "lon": entity.vehicle.position.longitude
-                }
-
-        for entity in feed.entity:
-            if not entity.HasField('trip_update'):
-                continue  # useless entity
-            trip_update = entity.trip_update
-            trip_id = f'{TELAVIV_GTFS_ID_PREFIX}{trip_update.trip.trip_id}'
-            for stop_time_update in trip_update.stop_time_update:
+        feed_time = datetime.fromtimestamp(timestamp, tz=ISRAEL_TZ)
+
+        for trip_id, vehicle_id, stop_time_updates in parsed_feed.trip_updates:
+            for stop_time_update in stop_time_updates:
                 if stop_time_update.stop_id not in stops_mapping:
                     continue
                 stop_code = stops_mapping[stop_time_update.stop_id]
                 if stop_code in requested_stop_codes:
-                    trip_info = None
-                    if trip_id in trips_data:
-                        trip_info = trips_data[trip_id]
-                        trip_info['trip_id'] = trip_id
-                    else:
+                    trip_info = trips_data.get(trip_id)
+                    if trip_info is None:
                         print('missing info for trip', trip_id)
-                    vehicle = { 'id': trip_update.vehicle.id,
-                                'position': vehicle_positions[trip_update.vehicle.id]}
-                    self.visits[stop_code].append(GtfsRtVisit(feed, stop_time_update, stop_code, trip_info, vehicle))
-
+                    vehicle = { 'id': vehicle_id,
+                                'position': parsed_feed.vehicle_positions[vehicle_id]}
+                    self.visits[stop_code].append(GtfsRtVisit(feed_time, stop_time_update, stop_code, trip_info, vehicle))
 
 
 class GtfsRtClient(object):
@@ -136,57 +149,77 @@ class GtfsRtClient(object):
         self.feed_url: str = feed_url
         self.db = db
         self.cache = SimpleMemoryCache()
+        self._session: aiohttp.ClientSession = None
 
     async def get_feed(self):
         feed = await self.cache.get('feed')
         if feed is None:
-            async with aiohttp.ClientSession() as session: # type: aiohttp.ClientSession
-                async with session.get(self.feed_url, headers={'Authorization': TELAVIV_AUTH_KEY}) as response: # type: aiohttp.ClientResponse
-                    contents = await response.read()
-                    feed: FeedMessage = FeedMessage()
-                    feed.ParseFromString(contents)
-                    await self.cache.set('feed', feed, ttl=30)
+            if self._session is None:
+                # Keep the session (and its keep-alive connection) around between feed refreshes
+                self._session = aiohttp.ClientSession(headers={'Authorization': TELAVIV_AUTH_KEY})
+            async with self._session.get(self.feed_url) as response: # type: aiohttp.ClientResponse
+                contents = await response.read()
+            # The feed is big, don't block the event loop while parsing it
+            loop = asyncio.get_event_loop()
+            feed: FeedMessage = await loop.run_in_executor(None, FeedMessage.FromString, contents)
+            await self.cache.set('feed', feed, ttl=30)
         return feed
 
+    async def close(self):
+        """ Close the HTTP session """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def get_lookup_tables(self, parsed_feed: ParsedFeed):
+        """ Get trip info (key'd on trip_id) and a stop_id -> stop_code mapping for all trip updates in the feed """
+        # collect all trip IDs and stop IDs in the feed
+        trip_ids = list({trip_id for trip_id, _, _ in parsed_feed.trip_updates})
+        stop_ids = list({stop_time_update.stop_id
+                         for _, _, stop_time_updates in parsed_feed.trip_updates
+                         for stop_time_update in stop_time_updates})
+
+        # Look them all up in the cache at once, and query the DB for the rest
+        trip_infos, stop_codes = await asyncio.gather(
+            self.cache.multi_get([f'trip:{trip_id}' for trip_id in trip_ids]),
+            self.cache.multi_get([f'stop:{stop_id}' for stop_id in stop_ids]))
+        trips_data: Dict[str, Dict[str, str]] = {trip_id: trip_info
+                                                 for trip_id, trip_info in zip(trip_ids, trip_infos)
+                                                 if trip_info is not None}
+        stops_mapping: Dict[str, str] = {stop_id: stop_code
+                                         for stop_id, stop_code in zip(stop_ids, stop_codes)
+                                         if stop_code is not None}
+        trips_for_query = [trip_id for trip_id in trip_ids if trip_id not in trips_data]
+        stops_for_query = [stop_id for stop_id in stop_ids if stop_id not in stops_mapping]
+
+        routes_for_trips, stops_mapping_query = await asyncio.gather(
+            get_routes_for_trips(self.db, trips_for_query),
+            TAShabbatStop.get_mapped_stop_codes(self.db, stops_for_query))
+        trips_data.update(routes_for_trips)
+        stops_mapping.update(stops_mapping_query)
+        await asyncio.gather(
+            self.cache.multi_set([(f'trip:{trip_id}', trip) for trip_id, trip in routes_for_trips.items()],
+                                 ttl = 30 * MINUTES),
+            self.cache.multi_set([(f'stop:{stop_id}', stop_code) for stop_id, stop_code in stops_mapping_query.items()],
+                                 ttl = 30 * MINUTES))
+
+        return trips_data, stops_mapping
+
     async def request(self, stop_codes: List[str])  -> GtfsRtResponse:
         """ Get arrivals filtered for specific stops in a SIRI compatible format """
         # this is in a SIRI format because curlbus was built for it,
         # it's easier to reuse existing class + structure than to refactor all of curlbus
         feed = await self.get_feed()
-
-        # collect trip IDs and stop IDs for the DB query
-        trips_for_query = set()
-        stops_for_query = set()
-        trips_data: Dict[str, Dict[str, str]] = {}
-        stops_mapping: Dict[str, str] = {}
         timestamp = feed.header.timestamp
 
-        for entity in feed.entity:
-            if not entity.HasField('trip_update'):
-                continue  # useless entity
-            trip_id = f'{TELAVIV_GTFS_ID_PREFIX}{entity.trip_update.trip.trip_id}'
-            trip_info = await self.cache.get(f'trip:{trip_id}')
-            if trip_info is None:
-                trips_for_query.add(trip_id)
-            else:
-                trips_data[trip_id] = trip_info
-
-            for stop_time_update in entity.trip_update.stop_time_update:
-                stop_code = await self.cache.get(f'stop:{stop_time_update.stop_id}')
-                if stop_code is None:
-                    stops_for_query.add(stop_time_update.stop_id)
-                else:
-                    stops_mapping[stop_time_update.stop_id] = stop_code
-
-        routes_for_trips = await get_routes_for_trips(self.db, list(trips_for_query))
-        for trip_id, trip in routes_for_trips.items():
-            trips_data[trip_id] = trip
-            await self.cache.set(f'trip:{trip_id}', trip, ttl = 30 * MINUTES)
-
-        stops_mapping_query = await TAShabbatStop.get_mapped_stop_codes(self.db, stops_for_query)
-        for stop_id, stop_code in stops_mapping_query.items():
-            stops_mapping[stop_id] = stop_code
-            await self.cache.set(f'stop:{stop_id}', stop_code, ttl = 30 * MINUTES)
+        # The parsed feed and lookup tables only depend on the feed, so build them once per feed refresh
+        tables_key = f'feed_tables:{timestamp}'
+        tables = await self.cache.get(tables_key)
+        if tables is None:
+            parsed_feed = parse_feed(feed)
+            tables = (parsed_feed, *await self.get_lookup_tables(parsed_feed))
+            await self.cache.set(tables_key, tables, ttl=30)
+        parsed_feed, trips_data, stops_mapping = tables
 
         # cool, we know about the routes/stops. Now to create "visits" and assign them to stops
-        return GtfsRtResponse(feed, stop_codes, trips_data, stops_mapping, timestamp)
+        return GtfsRtResponse(parsed_feed, stop_codes, trips_data, stops_mapping, timestamp)
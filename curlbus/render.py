@@ -20,22 +20,17 @@
 from .siri import SIRIResponse
 from .operators import operator_names, operators_by_id
 from datetime import datetime
-import dateutil.tz
+from itertools import zip_longest
 from typing import Dict
 
 
 def table(header_lines: list, rows: list) -> str:
     """ Draw a unicode box drawing characters based table """
-    width : Dict[int, int] = {}
+    # First pass: calculate column width, transposing the rows into columns
+    width = [max(len(cell) for cell in column) + 2
+             for column in zip_longest(*rows, fillvalue="")]
 
-    # First pass: calculate column width
-    table_width = 0
-    for row in rows:
-        for x, cell in enumerate(row):
-            if x not in width or width[x] < len(cell) + 2:
-                width[x] = len(cell) + 2
-
-    table_width = sum(width.values()) + len(width) - 1
+    table_width = sum(width) + len(width) - 1
     header_width = max(len(line) for line in header_lines)
     if table_width < header_width:
         table_width = header_width
@@ -47,31 +42,22 @@ def table(header_lines: list, rows: list) -> str:
     for header_line in header_lines:
         ret.append(f"│{header_line.center(table_width)}│")
 
-    header_bottom_border = "╞"
+    # The borders are the same for every row, so build them once
+    dashes = ["─" * column_width for column_width in width]
+    header_bottom_border = "╞" + "╤".join("═" * column_width for column_width in width) + "╡"
+    middle_border = "├" + "┼".join(dashes) + "┤"
+    bottom_border = "╰" + "┴".join(dashes) + "╯"
 
     # Second pass: actual table content
+    last_row = len(rows) - 1
     for y, row in enumerate(rows):
-        processed = "│"
-        bottom_border = "├" if y < len(rows)-1 else "╰"
-        for x, cell in enumerate(row):
-            cell = cell.ljust(width[x])
-            processed += f"{cell}│"
-            bottom_border += "─" * len(cell)
-            if y == 0:
-                # Build header's bottom border
-                header_bottom_border += "═"*len(cell)
-                if x < len(row) - 1:
-                    header_bottom_border += "╤"
-            if y < len(rows)-1:
-                bottom_border += "┼" if x < len(row)-1 else "┤"
-            else:
-                bottom_border += "┴" if x < len(row)-1 else "╯"
         if y == 0:
-            header_bottom_border += "╡"
             ret.append(header_bottom_border)
-        ret.append(processed)
-        if row[0].strip() == "" or y == len(rows) - 1:
+        ret.append("│" + "│".join(cell.ljust(width[x]) for x, cell in enumerate(row)) + "│")
+        if y == last_row:
             ret.append(bottom_border)
+        elif row[0].strip() == "":
+            ret.append(middle_border)
     ret.append("\n")
 
     return "\n".join(ret)
@@ -95,11 +81,6 @@ def boxify(lines, side_margins=5, padding=2):
 
 
 def render_station_arrivals(stop_code: str, stop_info: dict, data: SIRIResponse) -> str:
-    ret = ""
-    if len(data.errors) > 0:
-        for error in data.errors:
-            ret += error
-            ret += '\n'
     try:
         stop_name = stop_info['name']['EN']
     except KeyError:
@@ -109,15 +90,26 @@ def render_station_arrivals(stop_code: str, stop_info: dict, data: SIRIResponse)
     header = [f"Stop #{stop_code}", stop_name]
     if stop_info['address'] and 'city' in stop_info['address'] and stop_info['address']['city']:
         header.append(stop_info['address']['city'])
+    if not arrivals:
+        # Common for quiet stops, nothing to merge or sort
+        return table(header, [["No buses in the next 30 minutes"]])
+
     table_rows = []
     merged_arrivals = {}
+    # All arrivals are timed against the same "now"
+    now = datetime.now().astimezone()
+    # operator_id -> operator name, arrivals are usually from a handful of operators
+    arrival_operator_names: Dict[str, str] = {}
     for arrival in arrivals:
-        operator_name = operator_names[int(arrival.operator_id)]
+        operator_name = arrival_operator_names.get(arrival.operator_id)
+        if operator_name is None:
+            operator_name = arrival_operator_names[arrival.operator_id] = operator_names[int(arrival.operator_id)]
         # operator_name = arrival.static_info['route']['agency']['name']['EN']
+        arrival_destination = arrival.static_info['route']['destination']
         try:
-            destination = arrival.static_info['route']['destination']['name']['EN']
+            destination = arrival_destination['name']['EN']
         except KeyError:
-            destination = arrival.static_info['route']['destination']['name']['HE']
+            destination = arrival_destination['name']['HE']
         except TypeError:
             destination = "???"
 
@@ -129,7 +121,7 @@ def render_station_arrivals(stop_code: str, stop_info: dict, data: SIRIResponse)
             line_number = arrival.vehicle_ref
 
         try:
-            city = arrival.static_info['route']['destination']['address']['city']
+            city = arrival_destination['address']['city']
         except TypeError:
             print(arrival.static_info)
             city = None
@@ -137,7 +129,7 @@ def render_station_arrivals(stop_code: str, stop_info: dict, data: SIRIResponse)
             print(arrival.static_info)
             city = None
         # TODO special-casing for Isral railways
-        eta_minutes = round((arrival.eta - datetime.now(dateutil.tz.tzlocal())).total_seconds() / 60)
+        eta_minutes = round((arrival.eta - now).total_seconds() / 60)
         if eta_minutes <= 0:
             eta_text = "Now"
         else:
@@ -168,8 +160,6 @@ def render_station_arrivals(stop_code: str, stop_info: dict, data: SIRIResponse)
         table_rows.append([arrival["line_number"], arrival["operator_name"], arrival["destination"], etas])
         if arrival["city"] is not None:
             table_rows.append(["", "", arrival["city"], ""])
-    if len(table_rows) == 0:
-        table_rows = [["No buses in the next 30 minutes"]]
 
     return table(header, table_rows)
 
@@ -183,6 +173,14 @@ def render_operator_index(data: list):
     return table(["Transit Operators"], ret)
 
 
+def _split_route_long_name(long_name: str) -> list:
+    """ Split a route's long name into origin and destination """
+    for separator in ('<->', ' - ', ' אל '):
+        if separator in long_name:
+            return long_name.split(separator)
+    return [long_name, ""]
+
+
 def render_route_alternatives(operator_id: str, routes: list) -> str:
     padding = 2
     routename = routes[0]['short_name']
@@ -191,36 +189,26 @@ def render_route_alternatives(operator_id: str, routes: list) -> str:
     ret = [f'There are multiple {operator_name} routes named {routename}.',
            "Which one do you want?", ""]
 
-    # Find width for boxes
-    width = padding
-    for route in routes:
-        if '<->' in route['long_name']:
-            separator = '<->'
-        else:
-            separator = ' - '
-        name_parts = route['long_name'].split(separator)
-        this_width = max(len(part) for part in name_parts) + 2
-        if this_width > width:
-            width = this_width
-
-    # Draw a box for every route
-    for index, route in enumerate(routes):
-        if '<->' in route['long_name']:
-            separator = '<->'
-        elif ' - ' in route['long_name']:
-            separator = ' - '
-        elif ' אל ' in route['long_name']:
-            separator = ' אל '
-        name_parts = route['long_name'].split(separator)
-        ret.append("╭"+("─"*width)+"╮")
-        ret.append("│" + name_parts[0].center(width) + "│")
-        ret.append("│" + "▼".center(width) + "│")
-        ret.append("│" + name_parts[1].center(width) + "│")
-        ret.append("│" + (" "*width) + "│")
-        ret.append("├" + ("─"*width) + "┤")
-        ret.append("│" + f"/{operator_slug}/{route['short_name']}/{index}".center(width) + "│")
-        ret.append("╰"+("─"*width)+"╯")
-        ret.append("")
+    # Split the names once, and find width for boxes
+    split_names = [_split_route_long_name(route['long_name']) for route in routes]
+    width = max([padding, *(len(part) + 2 for name_parts in split_names for part in name_parts)])
+
+    # Draw a box for every route. Only the names and the URL differ between boxes
+    top_border = "╭" + ("─" * width) + "╮"
+    arrow_line = "│" + "▼".center(width) + "│"
+    blank_line = "│" + (" " * width) + "│"
+    middle_border = "├" + ("─" * width) + "┤"
+    bottom_border = "╰" + ("─" * width) + "╯"
+    for index, (route, name_parts) in enumerate(zip(routes, split_names)):
+        ret.extend((top_border,
+                    "│" + name_parts[0].center(width) + "│",
+                    arrow_line,
+                    "│" + name_parts[1].center(width) + "│",
+                    blank_line,
+                    middle_border,
+                    "│" + f"/{operator_slug}/{route['short_name']}/{index}".center(width) + "│",
+                    bottom_border,
+                    ""))
 
     return "\n".join(ret)+"\n"
 
@@ -244,6 +232,7 @@ def render_route_map(route_info: dict, stops: list) -> str:
     routemap = []
     last_city = ""
     city_len = 0
+    now = datetime.now().astimezone()
     for index, stop in enumerate(stops):
         connector = "┣"
         if index == 0:
@@ -261,40 +250,35 @@ def render_route_map(route_info: dict, stops: list) -> str:
 
         # Now add the dotted connector in the middle
         if index > 0 and index < len(stops) - 1:
-            routemap.append([city, "┋", ""])
+            routemap.append((city, "┋ "))
         elif index == len(stops) - 1:
-            routemap.append(["", "┋", ""])
+            routemap.append(("", "┋ "))
 
-        fragment = []
-        if index == 0 or index == len(stops) - 1:
-            # city name is on the same line with the stop name on the edges
-            fragment.append(city)
-        else:
-            fragment.append("")
-        fragment.append(connector)
         if 'EN' in stop['name']:
             stop_name = stop['name']['EN']
         else:
             stop_name = stop['name']['HE']
-        stop_name += f" ({stop['stop_code']})"
-        fragment.append(stop_name)
+        line = f"{connector} {stop_name} ({stop['stop_code']})"
 
         if len(stop['etas']) > 0:
-            eta = sorted(stop['etas'])[0]
-            eta_minutes = round((eta - datetime.now(dateutil.tz.tzlocal())).total_seconds() / 60)
+            eta = min(stop['etas'])
+            eta_minutes = round((eta - now).total_seconds() / 60)
             if eta_minutes <= 0:
                 eta_text = "Now"
             else:
                 eta_text = str(eta_minutes) + "m"
+            line += f" - {eta_text}"
 
-            fragment.append(f"- {eta_text}")
-
-        # Add the line with the stop name
-        routemap.append(fragment)
+        # Add the line with the stop name,
+        # city name is on the same line with the stop name on the edges
+        if index == 0 or index == len(stops) - 1:
+            routemap.append((city, line))
+        else:
+            routemap.append(("", line))
 
-    for line in routemap:
-        line[0] = line[0].rjust(city_len + padding_left)
-        ret.append(" ".join(line))
+    # The city column can only be aligned once the longest city name is known
+    city_width = city_len + padding_left
+    ret.extend(f"{city:>{city_width}} {line}" for city, line in routemap)
 
     return '\n'.join(ret)+'\n'
 
@@ -25,54 +25,152 @@ from .render import render_station_arrivals, render_operator_index, render_route
 from .siri import SIRIClient
 from .gtfs.utils import (get_stop_info, get_routes, get_route_route,
                          get_arrival_gtfs_info, translate_route_name,
-                         count_routes, get_rail_stations, get_nearby_stops)
+                         count_routes, get_rail_stations, get_nearby_stops,
+                         set_shared_cache, cached_no_db, MINUTES)
 from .gtfs import model as gtfs_model
 from .gtfs_rt import GtfsRtClient
 from .html import html_template, relative_linkify
-from aiocache import SimpleMemoryCache
+from sqlalchemy import select
+from collections import defaultdict
 from datetime import datetime
+import asyncio
+import functools
 import os.path
 import ansi2html
 # monkey-patch ansi2html to get a more modern HTML document structure and a footer
 ansi2html.converter._html_template = html_template
 ansi2html.converter.linkify = relative_linkify
-CACHE_TTL = 30
 ANSI_RESET = "\033[0m\033[39m\033[49m"
+ANSICONV_OPTIONS = {"linkify": True, "title": "curlbus", "font_size": '16px'}
+# 5 meters, 10 meters, 50 meters, up to 1000 in 50m increments
+ALLOWED_RADII = frozenset((5, 10, *range(50, 1050, 50)))
+# Pages larger than this are converted to HTML off the event loop
+ANSI_TO_HTML_THREAD_THRESHOLD = 8192
+ACCEPT_TYPES = (("text/html", 'html'),
+                ("application/json", 'json'),
+                ("*/*", 'text'))
 
 
 def parse_accept_header(request):
     """ Returns `json`, `html`, or `text` according to the accept header """
+    return parse_accept(",".join(request.headers.getall('ACCEPT', ())))
+
+
+@functools.lru_cache(maxsize=256)
+def parse_accept(accept: str) -> str:
+    """ Returns `json`, `html`, or `text` for an accept header value.
+    Clients tend to send the same header every time, so results are cached """
     # This doesn't care for priorities, it'll take the first guess
-    accept = request.headers.getall('ACCEPT', [])
-    for item in accept:
-        for sub_item in item.lower().split(','):
-            if "text/html" in sub_item:
-                return 'html'
-            if "application/json" in sub_item:
-                return 'json'
-            if "*/*" in sub_item:
-                return 'text'
+    accept = accept.lower()
     # Default to text
-    return 'text'
+    ret = 'text'
+    first = len(accept)
+    for mimetype, kind in ACCEPT_TYPES:
+        index = accept.find(mimetype)
+        if index != -1 and index < first:
+            ret = kind
+            first = index
+    return ret
+
+
+def load_ansi_art(path: str) -> str:
+    """ Load a text art file, resetting the colors at the end of every line """
+    with open(path, "r", encoding="utf-8") as f:
+        return "\n".join(line + ANSI_RESET for line in f.read().splitlines())
+
+
+def convert_ansi_to_html(text: str) -> str:
+    """ Convert `text` to HTML using a converter of its own.
+    Ansi2HTMLConverter keeps state while converting, so a shared one can't be used from worker threads """
+    return ansi2html.converter.Ansi2HTMLConverter(**ANSICONV_OPTIONS).convert(text)
+
+
+def render_index() -> str:
+    ret = [load_ansi_art(os.path.join(os.path.dirname(__file__), "curlbus.txt"))]
+    ret.append("\n")
+    ret.append(f"curlbus v{__version__}".center(70))
+    ret.append("by Elad Alfassa".rjust(43))
+    ret.append("")
+    ret.append("Try /<stop_code> or /operators")
+    ret.append("")
+    ret.append("Source code: https://github.com/elad661/curlbus")
+    return "\n".join(ret)+"\n"
+
+
+@cached_no_db(ttl=30*MINUTES)
+async def get_operator_index(db):
+    """ Get all transit operators in the database """
+    response = []
+    Agency = gtfs_model.Agency
+    for operator in await db.all(select([Agency.agency_id, Agency.agency_name, Agency.agency_url])):
+        agency_id = int(operator.agency_id)
+        slug = operators_by_id.get(agency_id)
+        if slug is None:
+            continue
+        # no English translation, fall back to Hebrew name
+        name_en = operator_names.get(agency_id, operator.agency_name)
+        response.append({'id': operator.agency_id,
+                         'website': operator.agency_url,
+                         'name': {'HE': operator.agency_name,
+                                  'EN': name_en},
+                         'url': f'/{slug}'})
+    return response
+
+
+# The rendered (sorted) pages only change with the data they're rendered
+# from, so cache them for as long as the data itself is cached
+@cached_no_db(ttl=30*MINUTES)
+async def get_rendered_operator_index(db):
+    return render_operator_index(await get_operator_index(db))
+
+
+@cached_no_db(ttl=30*MINUTES)
+async def get_rendered_rail_stations(db):
+    return render_station_list(await get_rail_stations(db))
 
 
 class CurlbusServer(object):
     def __init__(self, config):
         db = Gino(model_classes=tuple(gtfs_model.tables))
-        app = web.Application(middlewares=[db])
+        # Not using gino's middleware: it shares a single connection for the
+        # whole request, which prevents running queries concurrently.
+        # Handlers use the db object directly, so each query borrows a
+        # connection from the pool and returns it as soon as it's done.
+        app = web.Application()
         # I don't quite get why aiohttp says I shouldn't just use self.config
         # for this, but whatever
         app["config"] = config
-        app["aiocache"] = SimpleMemoryCache()
-        app["ansiconv"] = ansi2html.converter.Ansi2HTMLConverter(linkify=True,
-                                                                 title="curlbus",
-                                                                 font_size='16px')
+        if "redis" in config:
+            # Share GTFS lookups between server processes. Bump the namespace
+            # after loading a new GTFS feed to invalidate old entries.
+            from aiocache import RedisCache
+            from aiocache.serializers import JsonSerializer
+            redis_config = config["redis"]
+            set_shared_cache(RedisCache(endpoint=redis_config.get("endpoint", "127.0.0.1"),
+                                        port=int(redis_config.get("port", 6379)),
+                                        namespace=redis_config.get("namespace", "curlbus:v1"),
+                                        serializer=JsonSerializer(),
+                                        timeout=1))
+        app["ansiconv"] = ansi2html.converter.Ansi2HTMLConverter(**ANSICONV_OPTIONS)
+        app["ansi_to_html"] = functools.lru_cache(maxsize=256)(app["ansiconv"].convert)
         app['siriclient'] = SIRIClient(config["mot"]["url"],
                                        config["mot"]["user_id"])
 
         app['gtfs-rt-client'] = GtfsRtClient(db)
 
-        db.init_app(app)
+        # Static text pages and logos, loaded once instead of reading files
+        # in the event loop for every request
+        app['index_text'] = render_index()
+        with open(os.path.join(os.path.dirname(__file__), "railwaymap.txt"), "r") as f:
+            app['railmap'] = f.read()
+        app['operator_logos'] = {operator_id: load_ansi_art(path)
+                                 for operator_id, path in operator_logos.items()}
+        app.on_cleanup.append(self.close_clients)
+
+        # Pool sizes from the config file are strings, asyncpg needs ints
+        gino_config = {key: int(value) if key in ("pool_min_size", "pool_max_size") else value
+                       for key, value in config["gino"].items()}
+        db.init_app(app, gino_config)
         app.router.add_static("/static/", os.path.join(os.path.dirname(__file__), '..', "static"))
         app.add_routes([web.get('/{prefix:0*}{stop_code:\d+(\+\d+)*}{tail:/*}', self.handle_station),
                         web.get('/operators{tail:/*}', self.handle_operator_index),
@@ -88,12 +186,25 @@ class CurlbusServer(object):
                         web.get('/{tail:/*}', self.handle_index)])
         self._app = app
 
+    async def close_clients(self, app):
+        await app['gtfs-rt-client'].close()
+        await app['siriclient'].close()
+
     def run(self, appconfig):
         web.run_app(self._app, port=appconfig['port'], host=appconfig['host'])
 
-    def ansi_or_html(self, accept, request, text):
+    async def ansi_or_html(self, accept, request, text, static=False):
+        """ Respond with `text`, converted to HTML if requested.
+        Conversions of `static` texts (ones that don't change between requests) are cached,
+        large dynamic pages are converted in a worker thread to keep the event loop responsive """
         if accept == 'html':
-            text = request.app['ansiconv'].convert(text)
+            if static:
+                text = request.app['ansi_to_html'](text)
+            elif len(text) > ANSI_TO_HTML_THREAD_THRESHOLD:
+                loop = asyncio.get_event_loop()
+                text = await loop.run_in_executor(None, convert_ansi_to_html, text)
+            else:
+                text = request.app['ansiconv'].convert(text)
             return web.Response(text=text, content_type="text/html")
         return web.Response(text=text)
 
@@ -124,7 +235,7 @@ class CurlbusServer(object):
 
     async def handle_station(self, request):
         """ Get real-time arrivals for a specific station """
-        db = request['connection']
+        db = request.app['db']
         stop_codes = request.match_info["stop_code"].split('+')
         # TODO bunching to limit request rate?
         # TODO IP-based rate limit?
@@ -171,11 +282,18 @@ class CurlbusServer(object):
                 filtered_visits = [visit for visit in visits if visit.line_name in line_names]
                 realtime.visits[stop_code] = filtered_visits
 
-        # add static GTFS info for each route
-        for _, visits in realtime.visits.items():
-            for arrival in visits:
-                gtfsinfo = await get_arrival_gtfs_info(arrival, db)
-                arrival.static_info = {"route": gtfsinfo}
+        # add static GTFS info for each route, looking up all arrivals concurrently.
+        # The same trip often arrives at more than one of the requested stops,
+        # so every trip is only looked up once
+        arrivals = [arrival for visits in realtime.visits.values() for arrival in visits]
+        unique_arrivals = {}
+        for arrival in arrivals:
+            unique_arrivals.setdefault((arrival.trip_id, arrival.operator_id, arrival.destination_id), arrival)
+        gtfsinfos = await asyncio.gather(*(get_arrival_gtfs_info(arrival, db)
+                                           for arrival in unique_arrivals.values()))
+        gtfsinfo_by_key = dict(zip(unique_arrivals.keys(), gtfsinfos))
+        for arrival in arrivals:
+            arrival.static_info = {"route": gtfsinfo_by_key[(arrival.trip_id, arrival.operator_id, arrival.destination_id)]}
 
         if accept == 'json':
             out = realtime.to_dict()
@@ -186,43 +304,30 @@ class CurlbusServer(object):
                 out['stops_info'] = {stop_code: stops[stop_code] for stop_code in stop_codes}
             return web.json_response(out)
         else:
-            text = ""
-            for stop_code in stop_codes:
-                text += render_station_arrivals(stop_code, stops[stop_code], realtime)
-            return self.ansi_or_html(accept, request, text)
+            text = "".join(render_station_arrivals(stop_code, stops[stop_code], realtime)
+                           for stop_code in stop_codes)
+            return await self.ansi_or_html(accept, request, text)
 
     async def handle_operator_index(self, request):
         """ Get the index of all transit operators in the database """
-        response = []
-        db = request['connection']
+        db = request.app['db']
         accept = parse_accept_header(request)
-        for operator in await db.all(gtfs_model.Agency.query):
-            if int(operator.agency_id) in operators_by_id:
-                operator_json = {'id': operator.agency_id,
-                                'website': operator.agency_url,
-                                'name': { 'HE': operator.agency_name },
-                                'url': f'/{operators_by_id[int(operator.agency_id)]}'}
-                if int(operator.agency_id) in operator_names:
-                    operator_json['name']['EN'] = operator_names[int(operator.agency_id)]
-                else:
-                    # no English translation, fall back to Hebrew name
-                    operator_json['name']['EN'] = operator_json['name']['HE']
-                response.append(operator_json)
         if accept == 'json':
-            return web.json_response(response)
+            return web.json_response(await get_operator_index(db))
         else:
-            text = render_operator_index(response)
-            return self.ansi_or_html(accept, request, text)
+            text = await get_rendered_operator_index(db)
+            return await self.ansi_or_html(accept, request, text, static=True)
 
     async def handle_route(self, request):
         """ Get a schematic map for a specific route """
-        operator = request.match_info['operator'].lower().strip("/")
-        db = request['connection']
-        if operator not in operators:
+        # The route patterns never match a slash, so there's nothing to strip
+        operator = request.match_info['operator'].lower()
+        db = request.app['db']
+        operator_id = operators.get(operator)
+        if operator_id is None:
             # Fail fast for invalid data
             return web.Response(text="Unknown operator, check /operators\n",
                                 status=404)
-        operator_id = operators[operator]
         route_number = request.match_info['route_number'].strip("/")
         try:
             alternative = request.match_info['alternative'].strip("/")
@@ -241,27 +346,22 @@ class CurlbusServer(object):
             routemap = await get_route_route(db, route.route_id, direction_id)
             if routemap is None:
                 text = "This route has no map! Strange..."
-                return self.ansi_or_html(accept, request, text)
+                return await self.ansi_or_html(accept, request, text, static=True)
 
             # get realtime ETAs for each stop in this route
-            stop_codes = [stop.stop_code for stop in routemap]
+            stop_codes = [stop["stop_code"] for stop in routemap]
             realtime = await self.realtime_request(request, stop_codes)
-            etas = {}
+            etas = defaultdict(list)
+            route_id = route.route_id
             for stop_code, visits in realtime.visits.items():
-                for visit in visits:
-                    if visit.route_id == route.route_id:
-                        if stop_code in etas:
-                            etas[stop_code].append(visit.eta)
-                        else:
-                            etas[stop_code] = [visit.eta]
+                etas[stop_code].extend(visit.eta for visit in visits if visit.route_id == route_id)
 
             # Merge route map with etas:
-            mergedmap = []
-            for stop in routemap:
-                mergedmap.append({"stop_code": stop.stop_code,
-                                  "etas": etas.get(stop.stop_code, []),
-                                  "address": stop.address,
-                                  "name": stop.translated_name})
+            mergedmap = [{"stop_code": stop["stop_code"],
+                          "etas": etas.get(stop["stop_code"], []),
+                          "address": stop["address"],
+                          "name": stop["name"]}
+                         for stop in routemap]
 
             route_name = await translate_route_name(db, route)
             route_info = {"operator_name": operator_names[operator_id],
@@ -272,42 +372,39 @@ class CurlbusServer(object):
                                           "map": mergedmap})
             else:
                 text = render_route_map(route_info, mergedmap)
-                return self.ansi_or_html(accept, request, text)
+                return await self.ansi_or_html(accept, request, text)
         elif len(routes) > 1 and not alternative:
             # Render route alternative selection screen
-            alternatives = []
-            for route, direction_id in routes:
-                alternatives.append({"long_name": await translate_route_name(db, route),
-                                     "short_name": route.route_short_name})
+            names = await asyncio.gather(*(translate_route_name(db, route) for route, _ in routes))
+            alternatives = [{"long_name": name, "short_name": route.route_short_name}
+                            for name, (route, _) in zip(names, routes)]
             if accept == 'json':
                 return web.json_response({"route_alternatives": alternatives})
             else:
                 text = render_route_alternatives(operator_id, alternatives)
-                return self.ansi_or_html(accept, request, text)
+                return await self.ansi_or_html(accept, request, text, static=True)
         else:
             return web.Response(text="Unknown route!\n",
                                 status=404)
 
     async def handle_operator(self, request):
         """ Get a specific operator's page """
-        operator = request.match_info['operator'].lower().strip("/")
-        if operator not in operators:
+        operator = request.match_info['operator'].lower()
+        operator_id = operators.get(operator)
+        if operator_id is None:
             return web.Response(text="Unknown operator!\n try /operators\n",
                                 status=404)
-        operator_id = operators[operator]
         operator_name = operator_names[operator_id]
         ret = ["\n"]
 
-        db = request['connection']
+        db = request.app['db']
         accept = parse_accept_header(request)
         route_count = await count_routes(db, operator_id)
 
-        if operator_id in operator_logos:
+        logo = request.app['operator_logos'].get(operator_id)
+        if logo is not None:
             # Cool, there's a logo for this operator, draw it
-            with open(operator_logos[operator_id], "r") as f:
-                logo = f.read()
-            for line in logo.splitlines():
-                ret.append(line + ANSI_RESET)
+            ret.append(logo)
             ret.append("\n")
         if route_count > 0:
             if operator != "rail":
@@ -318,11 +415,11 @@ class CurlbusServer(object):
             # Special casing for unfortunate operators, such as the Carmelit
             ret.append(f"{operator_name} has no routes :(")
         text = "\n".join(ret)+"\n"
-        return self.ansi_or_html(accept, request, text)
+        return await self.ansi_or_html(accept, request, text, static=True)
 
     async def handle_nearby(self, request):
         """ Get nearby stops """
-        db = request['connection']
+        db = request.app['db']
         try:
             # Rounding lat and lon to 5 decimal digits to avoid cache bloat
             lat = round(float(request.query['lat']), 5)
@@ -337,10 +434,8 @@ class CurlbusServer(object):
             except ValueError:
                 return web.Response(text=f"Radius must be a number",
                                     status=400)
-            # 5 meters, 10 meters, 50 meters, up to 1000 in 50m increments
-            allowed_radii = [5, 10, *range(50, 1050, 50)]
-            if radius not in allowed_radii:
-                return web.Response(text=f"Radius not allowed, try one of {allowed_radii}",
+            if radius not in ALLOWED_RADII:
+                return web.Response(text=f"Radius not allowed, try one of {sorted(ALLOWED_RADII)}",
                                     status=400)
         except KeyError:
             radius = 300
@@ -348,39 +443,21 @@ class CurlbusServer(object):
         return web.json_response(await get_nearby_stops(db, lat, lon, radius))
 
     async def handle_rail_stations(self, request):
-        db = request['connection']
+        db = request.app['db']
         accept = parse_accept_header(request)
-        stations = await get_rail_stations(db)
         if accept == "json":
-            return web.json_response(stations)
+            return web.json_response(await get_rail_stations(db))
         else:
-            rendered = render_station_list(stations)
-            return self.ansi_or_html(accept, request, rendered)
+            rendered = await get_rendered_rail_stations(db)
+            return await self.ansi_or_html(accept, request, rendered, static=True)
 
     async def handle_rail_map(self, request):
         accept = parse_accept_header(request)
         if accept == "json":
             return web.json_response("not available for this endpoint")
         else:
-            railmap = os.path.join(os.path.dirname(__file__), "railwaymap.txt")
-            with open(railmap, "r") as f:
-                railmap = f.read()
-            return self.ansi_or_html(accept, request, railmap)
+            return await self.ansi_or_html(accept, request, request.app['railmap'], static=True)
 
     async def handle_index(self, request):
-        ret = []
-        logo = os.path.join(os.path.dirname(__file__), "curlbus.txt")
-        with open(logo, "r", encoding="utf-8") as f:
-            logo = f.read()
-        for line in logo.splitlines():
-            ret.append(line + ANSI_RESET)
-        ret.append("\n")
-        ret.append(f"curlbus v{__version__}".center(70))
-        ret.append("by Elad Alfassa".rjust(43))
-        ret.append("")
-        ret.append("Try /<stop_code> or /operators")
-        ret.append("")
-        ret.append("Source code: https://github.com/elad661/curlbus")
-        text = "\n".join(ret)+"\n"
         accept = parse_accept_header(request)
-        return self.ansi_or_html(accept, request, text)
+        return await self.ansi_or_html(accept, request, request.app['index_text'], static=True)
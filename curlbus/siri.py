@@ -18,14 +18,14 @@
 
 from typing import Dict, List
 import aiohttp
-import dateutil.parser
-import dateutil.tz
+import asyncio
 import json
-import time
+from datetime import datetime
 from aiocache import SimpleMemoryCache
 from aiocache.base import BaseCache
-from itertools import zip_longest
 GROUP_SIZE = 120
+MAX_CONCURRENT_GROUPS = 4
+""" How many groups are requested from the SIRI server at the same time """
 
 URL = None
 
@@ -38,12 +38,28 @@ def _listify(obj):
         return [obj]
 
 
-def _grouper(iterable, n, fillvalue=None):
-    "Collect data into fixed-length chunks or blocks"
-    # From itertools recipies: https://docs.python.org/3/library/itertools.html
-    # grouper('ABCDEFG', 3, 'x') --> ABC DEF Gxx"
-    args = [iter(iterable)] * n
-    return zip_longest(*args, fillvalue=fillvalue)
+def _parse_datetime(timestamp: str) -> datetime:
+    """ Parse a SIRI timestamp.
+    These are ISO 8601, which datetime parses much faster than dateutil's guesswork,
+    dateutil is only used for anything datetime can't handle """
+    try:
+        return datetime.fromisoformat(timestamp)
+    except (ValueError, AttributeError):
+        # AttributeError: Python 3.6 doesn't have fromisoformat.
+        # dateutil is only imported when it's actually needed
+        import dateutil.parser
+        return dateutil.parser.parse(timestamp)
+
+
+def _str_or_none(obj):
+    """ Convert the object to a string, unless it's None """
+    return None if obj is None else str(obj)
+
+
+def _chunks(items: list, n: int):
+    """ Split a list into lists of up to n items, without padding the last one """
+    # chunks('ABCDEFG', 3) --> ABC DEF G
+    return [items[i:i + n] for i in range(0, len(items), n)]
 
 
 class SIRIResponse(object):
@@ -51,14 +67,12 @@ class SIRIResponse(object):
         if verbose:
             print(json.dumps(json_response, indent=2))
 
-        self.visits: Dict[str, List[SIRIStopVisit]] = {}
+        # Every requested stop gets an entry, even if it has no visits
+        self.visits: Dict[str, List[SIRIStopVisit]] = {stop_code: [] for stop_code in stop_codes}
         """ Stop visits. A dictionary in the form of {stop_code: SIRIStopVisit} """
         self.errors: List[str] = []
         """ Errors, if any"""
 
-        for stop_code in stop_codes:
-            self.visits[str(stop_code)] = []
-
         # ew.
         try:
             response = json_response['Siri']['ServiceDelivery']
@@ -77,7 +91,8 @@ class SIRIResponse(object):
                 elif 'MonitoredStopVisit' in delivery:
                     for visit in _listify(delivery['MonitoredStopVisit']):
                         stop_visit = SIRIStopVisit(visit)
-                        self.visits[stop_visit.stop_code].append(stop_visit)
+                        # setdefault: the server might return visits for stops we didn't ask for
+                        self.visits.setdefault(stop_visit.stop_code, []).append(stop_visit)
 
     def to_dict(self) -> dict:
         """ Serialize to a dict format which is more readable than the original source """
@@ -93,10 +108,13 @@ class SIRIResponse(object):
         self.errors += other.errors
         for stop_code, visits in other.visits.items():
             if stop_code in self.visits:
+                my_visits = self.visits[stop_code]
+                existing = set(my_visits)
                 for visit in visits:
-                    if not any(my_visit == visit for my_visit in self.visits[stop_code]):
+                    if visit not in existing:
                         # a new visit! let's apped it
-                        self.visits[stop_code].append(visit)
+                        existing.add(visit)
+                        my_visits.append(visit)
             else:
                 self.visits[stop_code] = visits
 
@@ -106,13 +124,8 @@ class CachedSIRIResponse(SIRIResponse):
     def __init__(self, visits):
         self.errors = []
         self.visits: Dict[str, List[SIRIStopVisit]] = visits
-        self.timestamp = None
-
         # find a timestamp in one of the stops in this cache entry:
-        for stop_visits in visits.values():
-            if len(stop_visits) > 0:
-                self.timestamp = stop_visits[0].timestamp
-                break
+        self.timestamp = next((stop_visits[0].timestamp for stop_visits in visits.values() if stop_visits), None)
 
 
 class SIRIClient(object):
@@ -124,53 +137,123 @@ class SIRIClient(object):
         self.verbose = verbose
         self.cache_ttl = cache_ttl
         self._cache = cache if cache is not None else SimpleMemoryCache()
-        self._connector = None
+        self._session: aiohttp.ClientSession = None
+        self._group_semaphore: asyncio.Semaphore = None
+        self._inflight: Dict[str, asyncio.Future] = {}
+        """ Stops currently being requested from the server, and a future for their visits """
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """ Get the HTTP session, creating it on first use.
+        The session is kept between requests so connections to the SIRI server are reused """
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=32, ttl_dns_cache=300, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close(self):
+        """ Close the HTTP session """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _request_group(self, group: List[str], headers: Dict[str, str]) -> SIRIResponse:
+        """ Request real time information for a single group of up to GROUP_SIZE stops """
+        params = {
+            "Key": self.user_id,
+            "MonitoringRef": ','.join(group),
+        }
+        session = self._get_session()
+        if self._group_semaphore is None:
+            # Created on first use, so it belongs to the running event loop
+            self._group_semaphore = asyncio.Semaphore(MAX_CONCURRENT_GROUPS)
+        async with self._group_semaphore, session.get(self.url, params=params, headers=headers) as raw_response:
+            try:
+                json_response = await raw_response.json(encoding="utf-8")
+            except UnicodeDecodeError:
+                json_response = await raw_response.json()
+            except aiohttp.ContentTypeError as e:
+                print('Content type error', e)
+                print(await raw_response.text())
+                raise e
+
+        return SIRIResponse(json_response, group, self.verbose)
+
+    async def _fetch(self, stop_codes: List[str]) -> SIRIResponse:
+        """ Request real time information for `stop_codes`, cache it and
+        resolve the in-flight futures of these stops """
+        headers = {'Accept': 'application/json',
+                   'Accpet-Encoding': 'gzip,deflate'}
+        groups = _chunks(stop_codes, GROUP_SIZE)
+        try:
+            # Request all groups at once, so a big request costs one round trip instead of one per group
+            responses = await asyncio.gather(*[self._request_group(group, headers) for group in groups])
+            ret = None
+            for response in responses:
+                if ret:
+                    # Merge SIRIResponse objects if we have more than
+                    # one group
+                    if response.errors:
+                        print(response.errors)
+                    ret.append(response)
+                else:
+                    ret = response
+            # cache new visits before resolving the futures, so there's no
+            # moment where a stop is neither in flight nor cached
+            await self._cache.multi_set([(f"realtime:{stop_code}", visits)
+                                         for stop_code, visits in ret.visits.items()],
+                                        ttl=self.cache_ttl)
+        except BaseException as e:
+            # Let the requests waiting for these stops fail too, instead of hanging
+            for stop in stop_codes:
+                future = self._inflight.pop(stop)
+                if isinstance(e, asyncio.CancelledError):
+                    future.cancel()
+                else:
+                    future.set_exception(e)
+                    # Nobody might be waiting, don't warn about an unretrieved exception
+                    future.exception()
+            raise
+
+        for stop in stop_codes:
+            self._inflight.pop(stop).set_result(ret.visits.get(stop, []))
+        return ret
 
     async def request(self, stop_codes: List[str], max_visits: int = 50) -> SIRIResponse:
         """ Request real time information for stops in `stop_codes` """
         # Look for stop_codes in cache
         to_request = []
         from_cache = []
-        for stop in stop_codes:
-            cached = await self._cache.get(f"realtime:{stop}")
+        cached_visits = await self._cache.multi_get([f"realtime:{stop}" for stop in stop_codes])
+        for stop, cached in zip(stop_codes, cached_visits):
             if cached is None:
                 to_request.append(stop)
             else:
                 from_cache.append((stop, cached))
 
-        headers = {'Accept': 'application/json',
-                   'Accpet-Encoding': 'gzip,deflate'}
-        async with aiohttp.ClientSession() as session:
-            ret = None
-            for group in _grouper(to_request, GROUP_SIZE):
-                group = list(filter(None, group))
-                params = {
-                    "Key": self.user_id,
-                    "MonitoringRef": ','.join(group),
-                }
-                async with session.get(self.url, params=params, headers=headers) as raw_response:
-                    try:
-                        json_response = await raw_response.json(encoding="utf-8")
-                    except UnicodeDecodeError:
-                        json_response = await raw_response.json()
-                    except aiohttp.ContentTypeError as e:
-                        print('Content type error', e)
-                        print(await raw_response.text())
-                        raise e
-
-                    response = SIRIResponse(json_response, group, self.verbose)
-                    if ret:
-                        # Merge SIRIResponse objects if we have more than
-                        # one group
-                        if response.errors:
-                            print(response.errors)
-                        ret.append(response)
-                    else:
-                        ret = response
+        # Stops another request is already fetching are awaited instead of requested twice
+        loop = asyncio.get_event_loop()
+        in_flight = []
+        own_requests = []
+        for stop in to_request:
+            future = self._inflight.get(stop)
+            if future is None:
+                self._inflight[stop] = loop.create_future()
+                own_requests.append(stop)
+            else:
+                in_flight.append((stop, future))
+
+        ret = None
+        if own_requests:
+            # The fetch runs in its own task, so if this request is cancelled
+            # (e.g. the client disconnected) requests waiting for the same stops
+            # still get their results
+            ret = await asyncio.shield(asyncio.ensure_future(self._fetch(own_requests)))
+
+        if in_flight:
+            # shield(), so a cancelled request doesn't cancel the fetch other requests wait for
+            fetched = await asyncio.gather(*[asyncio.shield(future) for _, future in in_flight])
+            from_cache.extend((stop, visits) for (stop, _), visits in zip(in_flight, fetched))
         if ret is not None:
-            # cache new visits
-            for stop_code, visits in ret.visits.items():
-                await self._cache.set(f"realtime:{stop_code}", visits, ttl=self.cache_ttl)
             # add cached visits to the response
             for stop_code, visits in from_cache:
                 ret.visits[stop_code] = visits
@@ -180,11 +263,15 @@ class SIRIClient(object):
 
 
 class SIRIStopVisit(object):
+    # Responses can have thousands of visits, slots keep them small
+    __slots__ = ('producer', 'timestamp', 'stop_code', 'line_id', 'route_id', 'direction_id',
+                 'line_name', 'operator_id', 'destination_id', 'vehicle_ref', 'eta', 'trip_id',
+                 'status', 'departed', 'location', 'static_info')
+
     def __init__(self, src):
-        self._src = src
         self.producer = 'SIRI'
 
-        self.timestamp = dateutil.parser.parse(src['RecordedAtTime'])
+        self.timestamp = _parse_datetime(src['RecordedAtTime'])
         """  RecordedAtTime from the SIRI response, ie. the timestamp in which the prediction was made """
 
         self.stop_code = src['MonitoringRef']
@@ -220,7 +307,7 @@ class SIRIStopVisit(object):
         # Assuming singular MonitoredCall object.
         # need to change that assumption if the "onward calls" feature of version 2.8 will ever be used
         call = journey['MonitoredCall']
-        self.eta = dateutil.parser.parse(call['ExpectedArrivalTime'])
+        self.eta = _parse_datetime(call['ExpectedArrivalTime'])
         """ Estimated time for arrival """
 
         # Convert SIRI - style trip ID to GTFS style, to make it useful
@@ -228,7 +315,7 @@ class SIRIStopVisit(object):
         if 'FramedVehicleJourneyRef' in journey:
             journey_ref = journey['FramedVehicleJourneyRef']
 
-            tripdate = dateutil.parser.parse(journey_ref['DataFrameRef'])
+            tripdate = _parse_datetime(journey_ref['DataFrameRef'])
             tripdate = tripdate.strftime('%d%m%y')
 
             trip_id_part = journey_ref['DatedVehicleJourneyRef']
@@ -250,9 +337,9 @@ class SIRIStopVisit(object):
         """ The aimed departure time from the origin station. In some edge case, this is slightly different then the GTFS schedule """
 
         if 'AimedDepartureTime' in call:
-            self.departed = dateutil.parser.parse(call['AimedDepartureTime'])
+            self.departed = _parse_datetime(call['AimedDepartureTime'])
         elif 'OriginAimedDepartureTime' in journey:
-            self.departed = dateutil.parser.parse(journey['OriginAimedDepartureTime'])
+            self.departed = _parse_datetime(journey['OriginAimedDepartureTime'])
         else:
             self.departed = None
 
@@ -268,24 +355,31 @@ class SIRIStopVisit(object):
     def __repr__(self):
         return "SIRIStopVisit <line: {0}, eta: {1}>".format(self.line_id, self.eta)
 
+    def _key(self):
+        """ The fields that identify a stop visit, for comparing and hashing """
+        return (self.producer, self.stop_code, self.timestamp, self.eta,
+                self.route_id, self.vehicle_ref, self.direction_id)
+
+    def __hash__(self):
+        return hash(self._key())
+
     def __eq__(self, other):
-        return (self.producer == other.producer
-                and self.stop_code == other.stop_code
-                and self.timestamp == other.timestamp
-                and self.eta == other.eta
-                and self.route_id == other.route_id
-                and self.vehicle_ref == other.vehicle_ref
-                and self.direction_id == other.direction_id)
+        return self._key() == other._key()
 
     def to_dict(self) -> dict:
-        ret = {}
-        for key, value in self.__dict__.items():
-            if key.startswith("_"):
-                continue
-            if isinstance(value, (int, str, type(None), dict)):
-                ret[key] = value
-            elif callable(getattr(value, "to_dict", None)):
-                ret[key] = value.to_dict()
-            else:
-                ret[key] = str(value)
-        return ret
+        return {"producer": self.producer,
+                "timestamp": _str_or_none(self.timestamp),
+                "stop_code": self.stop_code,
+                "line_id": self.line_id,
+                "route_id": self.route_id,
+                "direction_id": self.direction_id,
+                "line_name": self.line_name,
+                "operator_id": self.operator_id,
+                "destination_id": self.destination_id,
+                "vehicle_ref": self.vehicle_ref,
+                "eta": _str_or_none(self.eta),
+                "trip_id": self.trip_id,
+                "status": self.status,
+                "departed": _str_or_none(self.departed),
+                "location": self.location,
+                "static_info": self.static_info}
@@ -30,13 +30,12 @@ from docopt import docopt
 import aiohttp
 import asyncio
 import configparser
-import csv
 import gino
-import io
 import time
 # https://data.gov.il/dataset/citiesandsettelments/resource/d4901968-dad3-4845-a9b0-a57d027f11ab
 DATASET_BASE_URL = "https://data.gov.il"
 DATASET = "/api/action/datastore_search?resource_id=d4901968-dad3-4845-a9b0-a57d027f11ab&include_total=true"
+FLIPPED_BRACKETS = str.maketrans({'(': ')', ')': '('})
 headers = { 'User-Agent': 'Mozilla/5.0 (X11; Fedora; Linux x86_64; rv:72.0) Gecko/20100101 Firefox/72.0' }
 
 db = model.db
@@ -44,15 +43,7 @@ db = model.db
 
 def flip_brackets(source: str) -> str:
     """ I can't believe this is needed, but it is - the brackets in the source are flipped! """
-    ret = ""
-    for char in source:
-        if char == '(':
-            ret += ')'
-        elif char == ')':
-            ret += '('
-        else:
-            ret += char
-    return ret
+    return source.translate(FLIPPED_BRACKETS)
 
 
 async def main():
@@ -72,29 +63,39 @@ async def main():
         print(f"Loading cities...")
         total = data['result']['total']
         processed = 0
+        total_saved = 0
         missing = []
         print(f"Total expected: {total}")
-        cities = []
-        while processed < total:
-            for row in data['result']['records']:
-                hebrew_name = flip_brackets(row['שם_ישוב'].strip())
-                english_name = row['שם_ישוב_לועזי'].strip().title()
-                if english_name:
-                    cities.append({'name': hebrew_name, 'english_name': english_name})
-                else:
-                    missing.append(hebrew_name)
-                processed += 1
-            next = data['result']['_links']['next']
-            if processed < total:
-                print(f'Have so far: {len(cities)} / {total}')
-                response = await session.get(DATASET_BASE_URL + next, headers=headers)
-                data = await response.json()
+        # Each page is inserted while the next one downloads. A transaction
+        # keeps the table unchanged if a later page fails.
+        async with db.bind.acquire() as conn, conn.transaction():
+            insert = None
+            while processed < total:
+                cities = []
+                for row in data['result']['records']:
+                    hebrew_name = flip_brackets(row['שם_ישוב'].strip())
+                    english_name = row['שם_ישוב_לועזי'].strip().title()
+                    if english_name:
+                        cities.append({'name': hebrew_name, 'english_name': english_name})
+                    else:
+                        missing.append(hebrew_name)
+                    processed += 1
+                total_saved += len(cities)
+                if insert is not None:
+                    await insert
+                    insert = None
+                if cities:
+                    insert = asyncio.ensure_future(conn.status(model.City.insert(), cities))
+                next = data['result']['_links']['next']
+                if processed < total:
+                    print(f'Have so far: {total_saved} / {total}')
+                    response = await session.get(DATASET_BASE_URL + next, headers=headers)
+                    data = await response.json()
+            if insert is not None:
+                await insert
 
-        total_saved = len(cities)
         print(f"Total saved: {total_saved} out of {processed}")
         print(f"Missing translations: {len(missing)} records, {missing}")
-        async with db.bind.acquire() as conn:
-            await conn.status(model.City.insert(), cities)
 
     print("Done")
     end = time.time()
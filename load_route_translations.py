@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+"""Usage: load_route_translations.py [-c <file>]
+
+Precompute English route names. Run after loading the GTFS feed and the city names.
+Options:
+  -c <file>, --config <file>  Use the specified configuration file.
+"""
+# Copyright (C) 2018 Elad Alfassa <elad@fedoraproject.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from curlbus.gtfs import model
+from curlbus.gtfs.utils import translate_route_long_name
+from docopt import docopt
+from sqlalchemy import select
+import asyncio
+import configparser
+import gino
+import time
+
+db = model.db
+
+
+async def main():
+    start = time.time()
+    arguments = docopt(__doc__)
+    configfile = arguments['--config'] or "config.ini"
+    config = configparser.ConfigParser()
+    config.read(configfile)
+    dsn = config['gino']['dsn']
+    engine = await gino.create_engine(dsn)
+    db.bind = engine
+    await db.gino.create_all()
+
+    routes = await db.all(select([model.Route.route_id, model.Route.route_long_name]))
+    print(f"Translating {len(routes)} routes...")
+    # Many routes share the same long name, translate each name only once
+    long_names = {route.route_long_name for route in routes if route.route_long_name}
+    translated = {}
+    for long_name in long_names:
+        translated[long_name] = await translate_route_long_name(db, long_name)
+
+    route_translations = [{'route_id': route.route_id,
+                           'long_name_en': translated[route.route_long_name]}
+                          for route in routes if route.route_long_name]
+    async with db.bind.acquire() as conn:
+        await conn.status(model.RouteTranslation.delete)
+        if route_translations:
+            await conn.status(model.RouteTranslation.insert(), route_translations)
+
+    print(f"Saved {len(route_translations)} route translations")
+    end = time.time()
+    total_time = end - start
+    print(f"Total time: {total_time} seconds")
+
+if __name__ == "__main__":
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main())
+    loop.close()
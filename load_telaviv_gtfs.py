@@ -29,27 +29,80 @@ Options:
 
 import asyncio
 import configparser
+import math
 import os.path
+from collections import defaultdict
 from csv import DictReader
 
 import gino
 from curlbus.gtfs import model
-from curlbus.gtfs.utils import get_nearby_stops
 from curlbus.gtfs.model import Stop
 from docopt import docopt
+from sqlalchemy import select
 
 db = model.db
 
+INSERT_CHUNK_SIZE = 1000
+INSERT_WORKERS = 4
+# Radius for matching stops by location, in meters
+FUZZY_MATCH_RADIUS = 9
+# Grid cells for the fuzzy match, in degrees. At Israel's latitude 0.0001 degrees
+# are more than 9 meters in both directions, so the 3x3 cells around a point
+# contain every stop in FUZZY_MATCH_RADIUS
+GRID_CELL_SIZE = 0.0001
+# Same as earthdistance's earth(), so matches agree with get_nearby_stops
+EARTH_RADIUS = 6378168
+
+
 def clean_name(name):
     return '/'.join([part.strip() for part in name.split('/')])
 
 
+def grid_cell(lat, lon):
+    return (math.floor(lat / GRID_CELL_SIZE), math.floor(lon / GRID_CELL_SIZE))
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """ Great circle distance between two points, in meters """
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+def find_nearby_stops(stops_grid, lat, lon):
+    """ Get the IDs of stops in FUZZY_MATCH_RADIUS meters from lat, lon """
+    cell_lat, cell_lon = grid_cell(lat, lon)
+    return [stop_id
+            for cell in ((cell_lat + i, cell_lon + j) for i in (-1, 0, 1) for j in (-1, 0, 1))
+            for stop_id, stop_lat, stop_lon in stops_grid.get(cell, ())
+            if distance(lat, lon, stop_lat, stop_lon) <= FUZZY_MATCH_RADIUS]
+
+
+async def insert_rows(table, rows):
+    """ Insert `rows` into `table` using COPY, one COPY per chunk.
+    The chunks are split between INSERT_WORKERS connections that insert concurrently """
+    columns = [column.name for column in table.__table__.columns]
+    records = [tuple(row.get(column) for column in columns) for row in rows]
+    chunks = [records[start:start + INSERT_CHUNK_SIZE] for start in range(0, len(records), INSERT_CHUNK_SIZE)]
+
+    async def insert_chunks(worker_chunks):
+        async with db.bind.acquire() as conn:
+            raw_connection = await conn.get_raw_connection()
+            for chunk in worker_chunks:
+                await raw_connection.copy_records_to_table(table.__tablename__, records=chunk, columns=columns)
+
+    await asyncio.gather(*(insert_chunks(chunks[worker::INSERT_WORKERS])
+                           for worker in range(min(INSERT_WORKERS, len(chunks)))))
+
+
 async def main():
     arguments = docopt(__doc__)
     configfile = arguments['--config'] or "config.ini"
     config = configparser.ConfigParser()
     config.read(configfile)
-    engine = await gino.create_engine(config['gino']['dsn'])
+    # The inserts never use more than INSERT_WORKERS connections at once
+    engine = await gino.create_engine(config['gino']['dsn'], min_size=1, max_size=INSERT_WORKERS)
     db.bind = engine
     await db.gino.create_all()
     print("Loading Tel Aviv weekend bus stops...")
@@ -63,40 +116,48 @@ async def main():
     by_name_with_cleanups = 0
     stop_mappings = {}
 
-    async def add_stop_mapping(stop, mot_stop):
-        mot_stop_id = mot_stop if type(mot_stop) == str else mot_stop.stop_id
-        await model.TAShabbatStop.create(ta_stop_id=stop['stop_id'], stop_id=mot_stop_id)
+    def add_stop_mapping(stop, mot_stop_id):
         stop_mappings[stop['stop_id']] = mot_stop_id
 
+    # Look up stops in memory instead of querying the DB up to four times per stop.
+    # setdefault keeps the first stop found for each key, like the LIMIT 1 queries did
+    ids_by_code = {}
+    ids_by_latlon = {}
+    ids_by_name = {}
+    stops_grid = defaultdict(list)
+    for mot_stop in await db.all(select([Stop.stop_id, Stop.stop_code, Stop.stop_name,
+                                         Stop.stop_lat, Stop.stop_lon])):
+        ids_by_code.setdefault(mot_stop.stop_code, mot_stop.stop_id)
+        ids_by_latlon.setdefault((mot_stop.stop_lat, mot_stop.stop_lon), mot_stop.stop_id)
+        ids_by_name.setdefault(mot_stop.stop_name, mot_stop.stop_id)
+        if mot_stop.stop_lat is not None and mot_stop.stop_lon is not None:
+            stops_grid[grid_cell(mot_stop.stop_lat, mot_stop.stop_lon)].append(
+                (mot_stop.stop_id, mot_stop.stop_lat, mot_stop.stop_lon))
+
     with open(os.path.join(directory, 'stops.txt'), 'r') as f:
         reader = DictReader(f)
         for stop in reader:
             if stop['stop_code'] != "":
                 # has stop code, let's see if we have it in the actual DB
-                query = Stop.query.where(Stop.stop_code == stop['stop_code'].strip()).limit(1)
-                query.bind = db
-                mot_stop = await query.gino.first()
-                if mot_stop is not None:
-                    await add_stop_mapping(stop, mot_stop)
+                mot_stop_id = ids_by_code.get(stop['stop_code'].strip())
+                if mot_stop_id is not None:
+                    add_stop_mapping(stop, mot_stop_id)
                     by_code += 1
                     continue
             if stop['stop_lat'] != "" and stop['stop_lon'] != "":
                 # Find stop by lat/lon
                 lat = float(stop['stop_lat'])
                 lon = float(stop['stop_lon'])
-                query = Stop.query.where(Stop.stop_lat == lat)\
-                                  .where(Stop.stop_lon == lon).limit(1)
-                query.bind = db
-                mot_stop = await query.gino.first()
-                if mot_stop is not None:
-                    await add_stop_mapping(stop, mot_stop)
+                mot_stop_id = ids_by_latlon.get((lat, lon))
+                if mot_stop_id is not None:
+                    add_stop_mapping(stop, mot_stop_id)
                     by_latlon += 1
                     continue
 
                 # fuzzy matching for lat/lon as a fallback
-                nearby = await get_nearby_stops(db, lat, lon, 9, return_ids_only=True)
+                nearby = find_nearby_stops(stops_grid, lat, lon)
                 if len(nearby) == 1:
-                    await add_stop_mapping(stop, nearby[0])
+                    add_stop_mapping(stop, nearby[0])
                     by_latlon_fuzzy += 1
                     continue
                 elif len(nearby) > 1:
@@ -104,25 +165,25 @@ async def main():
 
             if stop['stop_name'] != "":
                 # Last option - by name, chances of being wrong are very high as names are not unique :(
-                query = Stop.query.where(Stop.stop_name == stop['stop_name']).limit(1)
-                query.bind = db
-                mot_stop = await query.gino.first()
-                if mot_stop is not None:
-                    await add_stop_mapping(stop, mot_stop)
+                mot_stop_id = ids_by_name.get(stop['stop_name'])
+                if mot_stop_id is not None:
+                    add_stop_mapping(stop, mot_stop_id)
                     by_name += 1
                     continue
                 # Okay maybe if we trim the name a bit?
                 stop_name = clean_name(stop['stop_name']).replace('`', "'")
-                query = Stop.query.where(Stop.stop_name == stop_name).limit(1)
-                query.bind = db
-                mot_stop = await query.gino.first()
-                if mot_stop is not None:
-                    await add_stop_mapping(stop, mot_stop)
+                mot_stop_id = ids_by_name.get(stop_name)
+                if mot_stop_id is not None:
+                    add_stop_mapping(stop, mot_stop_id)
                     by_name_with_cleanups += 1
                     continue
 
             failed.append(stop)
 
+    # Insert everything in bulk instead of a round-trip per row
+    await insert_rows(model.TAShabbatStop, [{'ta_stop_id': ta_stop_id, 'stop_id': stop_id}
+                                            for ta_stop_id, stop_id in stop_mappings.items()])
+
     print(f"Imported: {len(stop_mappings.items())} stops")
     print(f"\tby code: {by_code}")
     print(f"\tby location: {by_latlon}")
@@ -136,16 +197,19 @@ async def main():
     print('Loading Tel Aviv weekend routes...')
     with open(os.path.join(directory, 'routes.txt'), 'r') as f:
         reader = DictReader(f)
+        routes = []
         for route in reader:
             route['route_id'] = f"ta{route['route_id']}"
             route['route_desc'] = f"ta{route['route_id']}-0-#"
             del route['route_url']
             del route['route_text_color']
             route['route_type'] = int(route['route_type'])
-            await model.Route.create(**route)
+            routes.append(route)
+    await insert_rows(model.Route, routes)
     print('Loading Tel Aviv weekend trips...')
     with open(os.path.join(directory, 'trips.txt'), 'r') as f:
         reader = DictReader(f)
+        trips = []
         for trip in reader:
             trip['route_id'] = f"ta{trip['route_id']}"
             trip['trip_id'] = f"ta{trip['trip_id']}"
@@ -153,11 +217,13 @@ async def main():
             del trip['trip_short_name']
             del trip['block_id']
             del trip['line_id']
-            await model.Trip.create(**trip)
+            trips.append(trip)
+    await insert_rows(model.Trip, trips)
 
     print('Loading Tel Aviv weekend stoptimes...')
     with open(os.path.join(directory, 'stop_times.txt'), 'r') as f:
         reader = DictReader(f)
+        stoptimes = []
         for stoptime in reader:
             if stoptime['stop_id'] not in stop_mappings:
                 continue
@@ -166,7 +232,8 @@ async def main():
             stoptime['pickup_type'] = bool(stoptime['pickup_type'])
             stoptime['drop_off_type'] = bool(stoptime['drop_off_type'])
             stoptime['stop_sequence'] = int(stoptime['stop_sequence'])
-            await model.StopTime.create(**stoptime)
+            stoptimes.append(stoptime)
+    await insert_rows(model.StopTime, stoptimes)
 
 
 if __name__ == "__main__":
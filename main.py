@@ -23,12 +23,23 @@ Start curlbus web server
 Options:
   -c <file>, --config <file>  Use the specified configuration file.
 """
+import asyncio
 import configparser
 from docopt import docopt
 from curlbus.server import CurlbusServer
 
 
+def install_uvloop():
+    """ Use uvloop for the event loop if it's installed, it's faster than asyncio's default loop """
+    try:
+        import uvloop
+    except ImportError:
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+
 def main():
+    install_uvloop()
     arguments = docopt(__doc__)
     configfile = arguments['--config'] or "config.ini"
     config = configparser.ConfigParser()
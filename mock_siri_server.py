@@ -26,51 +26,62 @@ Options:
   -c <file>, --config <file>  Use the specified configuration file.
   -p <port>, --port <port>  Port to listen on. Defaults to 8081
 """
-import dateutil.tz
+import asyncio
 import configparser
+import functools
 from docopt import docopt
 from aiohttp import web
 from gino.ext.aiohttp import Gino
 from curlbus.gtfs import model as gtfs_model
+from curlbus.gtfs.utils import query_routes_for_trips
 from random import randint
 from datetime import datetime, timedelta
 from dateutil.parser import parse
-
-RANDOM_TRIPS_QUERY = """SELECT t.trip_id
-                        FROM stoptimes as st
-                        JOIN trips as t ON t.trip_id=st.trip_id
-                        JOIN stops as s ON s.stop_id=st.stop_id
-                        WHERE s.stop_code='{code}'
-                        GROUP BY t.trip_id
-                        ORDER BY random() LIMIT 5;"""
+from sqlalchemy import text
+
+# Filter stoptimes by the stop's ids first (both columns are indexed) and only
+# shuffle the trips that stop there, then fetch the columns the response needs
+# for the chosen trips in the same query.
+RANDOM_TRIPS_QUERY = text("""SELECT t.trip_id, t.route_id, t.direction_id
+                             FROM trips as t
+                             WHERE t.trip_id IN (
+                                 SELECT trip_id FROM (
+                                     SELECT DISTINCT st.trip_id
+                                     FROM stoptimes as st
+                                     WHERE st.stop_id IN (SELECT stop_id FROM stops
+                                                          WHERE stop_code=:stop_code)
+                                 ) AS stop_trips
+                                 ORDER BY random() LIMIT 5
+                             );""")
 
 
 async def random_trips(db, stop_code: int):
     """ Get random trips for a stop """
     # Query random trips that actually happen in this stop
-    result = await db.all(RANDOM_TRIPS_QUERY.format(code=stop_code))
-    trips = [r[0] for r in result]  # remove the noise
-    # get ORM trip objects
-    query = gtfs_model.Trip.query.where(gtfs_model.Trip.trip_id.in_(trips))
-    return await db.all(query)
+    return await db.all(RANDOM_TRIPS_QUERY, stop_code=str(stop_code))
 
 
-async def get_route_for_trip(db, trip: gtfs_model.Trip) -> gtfs_model.Route:
-    query = gtfs_model.Route.query.where(gtfs_model.Route.route_id == trip.route_id)
-    return (await db.all(query))[0]
+@functools.lru_cache(maxsize=1024)
+def parse_trip_date(trip_date: str) -> datetime:
+    """ Parse the date part of a trip ID. There are only a few different dates in the feed """
+    return parse(trip_date)
 
 
 def now():
-    return datetime.now(dateutil.tz.tzlocal())
+    return datetime.now().astimezone()
 
 
 class MockSIRIServer(object):
     def __init__(self, config):
         db = Gino(model_classes=tuple(gtfs_model.tables))
-        app = web.Application(middlewares=[db])
+        # No gino middleware, so queries don't share a single per-request
+        # connection and each one holds a pooled connection only while it runs
+        app = web.Application()
         app["config"] = config
 
-        db.init_app(app)
+        gino_config = {key: int(value) if key in ("pool_min_size", "pool_max_size") else value
+                       for key, value in config["gino"].items()}
+        db.init_app(app, gino_config)
         app.add_routes([web.get('/{tail:.*}', self.handle_request)])
         self._app = app
 
@@ -78,10 +89,13 @@ class MockSIRIServer(object):
         web.run_app(self._app, port=port)
 
     async def handle_request(self, request):
+        # All times in the response are based on the same "now"
+        request_time = now()
+        request_timestamp = str(request_time)
         response = {
             "Siri": {
                 "ServiceDelivery": {
-                    "ResponseTimestamp": str(now()),
+                    "ResponseTimestamp": request_timestamp,
                     "ProducerRef": "Mock Siri Server",
                     "ResponseMessageIdentifier": 7603,
                     "RequestMessageRef": "[REDACTED]",
@@ -89,7 +103,7 @@ class MockSIRIServer(object):
                     "StopMonitoringDelivery": {
                         "-version": "2.8",
                         "Status": "true",
-                        "ResponseTimestamp": str(now()),
+                        "ResponseTimestamp": request_timestamp,
                         "MonitoredStopVisit": [
                             # To be filled
                         ]
@@ -101,21 +115,25 @@ class MockSIRIServer(object):
 
         visits = response['Siri']['ServiceDelivery']['StopMonitoringDelivery']['MonitoredStopVisit']
         print(request.query['MonitoringRef'])
-        for stop in request.query['MonitoringRef'].split(','):
-            for i, trip in enumerate(await random_trips(db, stop)):
-                # Collect variables
-                route = await get_route_for_trip(db, trip)
-                destination_code = await trip.get_last_stop_code(db)
-                timestamp = now()
+        stop_codes = request.query['MonitoringRef'].split(',')
+        trips_per_stop = await asyncio.gather(*(random_trips(db, stop) for stop in stop_codes))
+        # Routes and destinations for all trips in the response, in one go.
+        # Not cached: the trips are random, the same list won't come up again
+        trips_info = await query_routes_for_trips(db, list({trip.trip_id
+                                                           for trips in trips_per_stop
+                                                           for trip in trips}))
+        for stop, trips in zip(stop_codes, trips_per_stop):
+            for i, trip in enumerate(trips):
+                trip_info = trips_info[trip.trip_id]
 
                 # Make up random times
-                eta = now() + timedelta(minutes=randint(0, 30))
-                departed = now() - timedelta(minutes=randint(0, 180))
+                eta = request_time + timedelta(minutes=randint(0, 30))
+                departed = request_time - timedelta(minutes=randint(0, 180))
                 trip_id = trip.trip_id.split('_')[0]
-                trip_date = parse(trip.trip_id.split('_')[1])
+                trip_date = parse_trip_date(trip.trip_id.split('_')[1])
 
                 visits.append({
-                    "RecordedAtTime": str(timestamp),
+                    "RecordedAtTime": request_timestamp,
                     "ItemIdentifier": i,
                     "MonitoringRef": stop,
                     "MonitoredVehicleJourney": {
@@ -125,9 +143,9 @@ class MockSIRIServer(object):
                             "DataFrameRef": str(trip_date),
                             "DatedVehicleJourneyRef": trip_id
                         },
-                        "PublishedLineName": route.route_short_name,
-                        "OperatorRef": route.agency_id,
-                        "DestinationRef": destination_code,
+                        "PublishedLineName": trip_info['route_short_name'],
+                        "OperatorRef": trip_info['agency_id'],
+                        "DestinationRef": trip_info['destination_code'],
                         "OriginAimedDepartureTime": str(departed),
                         "VehicleLocation": {
                             "Longitude": 34.746543884277344,
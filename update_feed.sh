@@ -6,7 +6,8 @@ DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null && pwd )"
 pushd ${DIR}
     POSTGRES_DSN="$(python3 -c 'import configparser; c = configparser.ConfigParser(); c.read("config.ini"); print(c["gino"]["dsn"])')"
     wget ftp://gtfs.mot.gov.il/israel-public-transportation.zip -O israel-public-transportation.zip
-    python3 create_tables.py
+    # Indexes are created after loading everything, see the end of this script
+    python3 create_tables.py --drop-indexes
     TEMP_DIR="$(mktemp -d)"
     unzip israel-public-transportation.zip -d "$TEMP_DIR"
     pushd "$TEMP_DIR"
@@ -46,4 +47,6 @@ pushd ${DIR}
     popd
     python3 load_telaviv_gtfs.py "$TEMP_DIR"
     rm -fr "$TEMP_DIR"
+    echo 'creating indexes...'
+    python3 create_tables.py
 popd